@@ -2,9 +2,10 @@ import serial
 import alicat
 import time
 import os
-import csv
 import tabulate 
 import copy
+from log_writer import LogWriter
+import rxn_clock
 class Device():
 	def __init__(self,params,config,mock=False,rxn_dir=None):
 		self.config = config
@@ -15,15 +16,14 @@ class Device():
 
 		self.rxn_dirname = rxn_dir
 		self.logfile_location = os.path.join(self.rxn_dirname, "{}.csv".format("6flow_flow_pv_log"))
-		self.logtimer = time.time()
+		self.logtimer = rxn_clock.now()
 		self.log_time_interval = 10 #seconds
 		self.cached_pv = None
+		self.last_bulk_report = None #result of the last bulk_set_sp
 		self.reactors = ["1","2","3","4","5","6"]
 		self.headers = copy.copy(self.reactors)
 		self.headers.insert(0,"Time")
-		with open(self.logfile_location,'w') as f:
-			csv_writer = csv.writer(f, delimiter=',', lineterminator='\n',quoting=csv.QUOTE_MINIMAL)
-			csv_writer.writerow(self.headers) #write header
+		self.log_writer = LogWriter.from_settings(self.logfile_location,self.headers,self.config) #write header
 
 		if mock:
 			for subdev_name in params.keys(): #for each subdevice in input file
@@ -44,28 +44,25 @@ class Device():
 
 	def get_pv(self,subdev_name):
 		if subdev_name == "Bulk SP":
-			elapsed_time = time.time()-self.logtimer
+			elapsed_time = rxn_clock.now()-self.logtimer
 
 			if elapsed_time > self.log_time_interval  or self.cached_pv == None:
-				flows = [time.ctime(time.time())]
+				flows = [rxn_clock.ctime()]
 				for i in self.reactors:
 					if self.subdevices[i].active_flow_controller == 1:
 						flows.append(self.subdevices[i].get_pv())
-						time.sleep(0.05)
 					else:
 						flows.append(-1)
 
 				#write to logfile
-				with open(self.logfile_location,'a') as f:
-					csv_writer = csv.writer(f, delimiter=',', lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
-					csv_writer.writerow(flows)
+				self.log_writer.writerow(flows)
 				
 				#Display
 				print("================== Flows ===================")
 				print(tabulate.tabulate([flows],headers=self.headers,floatfmt=".2f"))
 				print("\n")
 
-				self.logtimer = time.time()
+				self.logtimer = rxn_clock.now()
 				self.cached_pv = sum([i for i in flows if (i != -1 and type(i) != str)])/len([i for i in flows if (i != -1 and type(i) != str)])
 				return self.cached_pv #average pv of all MFCs reading
 			else:
@@ -80,16 +77,34 @@ class Device():
 	def set_sp(self,subdev_name,sp_value):
 		bool_ret = True
 		if subdev_name == "Bulk SP":
-			for subdev_name in self.reactors:
-				if self.subdevices[subdev_name].active_flow_controller==1: #is flow controller that is active
-					bool_ret= bool_ret and self.subdevices[subdev_name].set_sp(sp_value) #take the AND value of all the configured MFCs
-
+			bool_ret = self.bulk_set_sp(sp_value) #take the AND value of all the configured MFCs
 			self.subdevices["Bulk SP"].set_sp(sp_value)
 			return bool_ret
 
 		else:
 			return self.subdevices[subdev_name].set_sp(sp_value)
 
+	def bulk_set_sp(self,sp_value):
+		#Writes the setpoint to every active reactor back to back, then verifies all of them in one polling pass, so the reactors
+		#get their new flow as close together as possible. Per-reactor results and the write skew are kept in last_bulk_report.
+		active_reactors = [r for r in self.reactors if r in self.subdevices and self.subdevices[r].active_flow_controller==1] #is flow controller that is active
+		written = {}
+		write_times = []
+		start = time.perf_counter()
+		for r in active_reactors:
+			written[r] = self.subdevices[r].write_sp(sp_value)
+			write_times.append(time.perf_counter())
+		verified = {r : written[r] and self.subdevices[r].verify_sp(sp_value) for r in active_reactors}
+
+		self.last_bulk_report = {"Setpoint" : sp_value,
+								"Reactors" : {r : {"Written" : written[r],"Verified" : verified[r]} for r in active_reactors},
+								"Skew (s)" : (write_times[-1]-start) if write_times else 0, #first write sent -> last write acknowledged
+								"Duration (s)" : time.perf_counter()-start}
+		failed = [r for r in active_reactors if not verified[r]]
+		print("Bulk SP {}: {}/{} reactors confirmed, write skew {:.3f} s.{}".format(sp_value,len(active_reactors)-len(failed),len(active_reactors),
+				self.last_bulk_report["Skew (s)"]," Failed: {}".format(failed) if failed else ""))
+		return len(failed) == 0
+
 	def is_emergency(self,subdev_name,pv_read_time,sp_set_time,current_sp,current_pv):
 		return self.subdevices[subdev_name].is_emergency(self.wait_time,pv_read_time,sp_set_time,current_sp,current_pv)
 
@@ -124,6 +139,10 @@ class Mock_Subdevice():
 	def set_sp(self,sp_value):
 		self.current_sp = sp_value
 		return True
+	def write_sp(self,sp_value):
+		return self.set_sp(sp_value)
+	def verify_sp(self,sp_value):
+		return self.current_sp == sp_value
 
 	def get_sp(self):
 		return self.current_sp
@@ -143,8 +162,15 @@ class Subdevice():
 		self.current_sp = None
 		self.dev_lim = float(config["Dev Lim"])
 		self.active_flow_controller = config["active_flow_controller"]
+		self.control_point = None
 		if name != "Bulk SP":
 			self.dev = alicat.FlowController(port=port,address=config["node"])
+			self.refresh_control_point()
+
+	def refresh_control_point(self):
+		#the control point (flow or gauge pressure) only changes if someone reconfigures the controller. Read it once and re-read on errors.
+		self.control_point = self.dev.get()['control_point']
+		return self.control_point
 
 	def is_emergency(self,wait_time,pv_read_time,sp_set_time,current_sp,current_pv):
 		if (pv_read_time-sp_set_time > wait_time):
@@ -157,13 +183,20 @@ class Subdevice():
 			return [False,self.name,current_sp,current_pv]
 
 	def get_pv(self):
-		""" Read the actual flow """ #If 10 errors then returns -99
-		if self.dev.get()['control_point'] == "gauge pressure":
-			time.sleep(0.05)
-			return float(self.dev.get()['pressure'])
+		""" Read the actual flow """
+		try:
+			if self.control_point is None: #cleared after a failed write
+				self.refresh_control_point()
+			return self.read_pv(self.dev.get())
+		except Exception: #bad frame or the control point changed. Re-read it and try once more
+			self.refresh_control_point()
+			return self.read_pv(self.dev.get())
+
+	def read_pv(self,state):
+		if self.control_point == "gauge pressure":
+			return float(state['pressure'])
 		else:
-			time.sleep(0.05)
-			return float(self.dev.get()['mass_flow'])
+			return float(state['mass_flow'])
 
 
 
@@ -174,22 +207,28 @@ class Subdevice():
 			return True
 
 		else:
-			try:
-				if self.dev.get()['control_point'] == "gauge pressure":
-					time.sleep(0.05)
-					self.dev.set_pressure(float(setpoint_in))
-				else:
-					time.sleep(0.05)
-					self.dev.set_flow_rate(float(setpoint_in))
-			except:
-				return False
-			time.sleep(0.05)
-			self.current_sp = setpoint_in
-			if float(self.dev.get()['setpoint']) == setpoint_in:
-				return True
-
+			return self.write_sp(setpoint_in) and self.verify_sp(setpoint_in)
+
+	def write_sp(self,setpoint_in):
+		#sends the setpoint frame without reading it back. Returns False if the write itself failed
+		try:
+			if self.control_point is None: #cleared after a failed write
+				self.refresh_control_point()
+			if self.control_point == "gauge pressure":
+				self.dev.set_pressure(float(setpoint_in))
 			else:
-				return False
+				self.dev.set_flow_rate(float(setpoint_in))
+		except:
+			self.control_point = None #re-read the control point before the next frame
+			return False
+		self.current_sp = setpoint_in
+		return True
+
+	def verify_sp(self,setpoint_in):
+		try:
+			return float(self.dev.get()['setpoint']) == setpoint_in
+		except:
+			return False
 
 
 	def get_sp(self):
@@ -1,24 +1,34 @@
 """Main module."""
 import pandas as pd
+import numpy as np
 import importlib
 import tabulate
-import time
 import json
-import csv
 import os
 import asyncio
 import traceback
+import heapq
+import concurrent.futures
+from log_writer import LogWriter, BinaryLogWriter
+import rxn_clock
+import serial_bus
+from live_analysis import LiveAnalysis
 
 class Reaction():
 	def __init__(self,inputs_df,settings_json,rxn_name, rxn_dirname,mock):
 		self.rxn_name = rxn_name
 		self.rxn_dirname = rxn_dirname
 
+		#check the whole recipe against the settings before touching any hardware
+		violations = validate_recipe(inputs_df,settings_json)
+		if violations:
+			raise ValueError("Recipe failed validation with {} violation(s):\n{}".format(len(violations),"\n".join(violations)))
 
 		self.devices = {} #a dictionary of devices
 		self.device_parameters = {} #Keep in mind parameters vs. config. Parameters = The parameters in the recipe specific to each subdevice/control point (emergency setpt, units, parent device name)
 		self.device_config = {} #config = the metadata stored in the settings json that is used to connect to the actual device, etc.
 		self.modules = {} #a dictionary of auxiliary communication modules, organized by major device
+		self.dispatcher = Dispatcher(inline=rxn_clock.is_virtual()) #runs blocking driver calls on one worker thread per physical port. Time-warp runs them inline so virtual time can't race the threads
 		self.dynamic_subdevices = [] #a list of subdevice names for devices classified as dynamic (setpt changes during a step)
 		#set up 
 		self.num_subdevs = 0
@@ -53,6 +63,9 @@ class Reaction():
 			self.modules[device_name] = importlib.import_module(device_name)	
 			self.device_config[device_name] = settings_json[device_name]
 			self.devices[device_name] = self.modules[device_name].Device(self.device_parameters[device_name],self.device_config[device_name],mock = mock,rxn_dir=self.rxn_dirname)
+			port_executor = self.dispatcher.add_device(device_name,self.device_config[device_name])
+			if hasattr(self.devices[device_name],"port_executor"): #async devices run their own blocking calls on the same port thread
+				self.devices[device_name].port_executor = port_executor
 			#setting async devices
 			if settings_json[device_name]["async"] == 0:
 				pass
@@ -64,6 +77,9 @@ class Reaction():
 			print("Subdevices of {} are {}".format(device_name,self.devices[device_name].subdevices.keys()))
 		#set up logging file
 		self.log_interval = float(settings_json["logger"]["log_interval (s)"]) #in seconds
+		self.gc_poll_interval = float(settings_json["logger"].get("gc_poll_interval (s)",5)) #in seconds
+		self.dynamic_update_interval = float(settings_json["logger"].get("dynamic_update_interval (s)",5)) #in seconds
+		self.gc_log_delay = float(settings_json["logger"].get("gc_log_delay (s)",75)) #seconds after an injection before the gc log row is created
 		self.logfile_location = os.path.join(self.rxn_dirname, "rxn_log_{}.csv".format(self.rxn_name))
 		self.num_subdev = len(inputs_df.columns[1:])
 		self.log_header = inputs_df.columns[1:].tolist()
@@ -75,19 +91,15 @@ class Reaction():
 			self.log_header[i+(self.num_subdev)] += " PV"
 		self.log_header.insert(0, "Reaction Name")
 		self.log_header.insert(0,"Time")
-		with open(self.logfile_location,'w') as f:
-			csv_writer = csv.writer(f, delimiter=',', lineterminator='\n',quoting=csv.QUOTE_MINIMAL)
-			csv_writer.writerow(self.log_header)
+		self.log_writer = LogWriter.from_settings(self.logfile_location,self.log_header,settings_json["logger"])
+		if settings_json["logger"].get("binary_log","False") in ["True","true","T"]: #optional typed copy of the log that can be memory-mapped for analysis
+			self.binary_log_writer = BinaryLogWriter.from_settings(os.path.join(self.rxn_dirname, "rxn_log_{}".format(self.rxn_name)),self.log_header[2:],settings_json["logger"],metadata={"Reaction Name" : self.rxn_name})
+		else:
+			self.binary_log_writer = None
 
 		#set up setpoint matrix
 		print(inputs_df.head())
-		self.setpt_matrix = inputs_df.iloc[4:,:].apply(pd.to_numeric)
-		for subdev_name in self.setpt_matrix.columns[1:]: #check to make sure each sp is below its max
-			parent_device_name = inputs_df[subdev_name][2]
-			for sp in self.setpt_matrix[subdev_name]:
-				config_max = self.device_config[parent_device_name]["Subdevices"][subdev_name]["Max Setting"]
-				if config_max != "None" and sp > config_max:
-					raise ValueError("Configured SP {} for subdevice {} exceeds max {}".format(sp,subdev_name,config_max))
+		self.setpt_matrix = inputs_df.iloc[4:,:].apply(pd.to_numeric) #max settings were already checked by validate_recipe
 
 
 		#set up gc and gc logging file
@@ -96,68 +108,102 @@ class Reaction():
 		self.gc = self.devices[self.gc_module_name]
 		self.gc_needs_logging = False
 
-		with open(self.gc_logfile_location,'w') as f:
-			csv_writer = csv.writer(f, delimiter=',',lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
-			self.gc_header = list(inputs_df.columns[1:])
-			self.gc_header.insert(0,"GC Time Stamp")
-			self.gc_header.insert(0,"GC Run ID")
-			self.gc_header.insert(0,self.gc_module_name)
-			self.gc_header.insert(0, "Reaction Name")
-			csv_writer.writerow(self.gc_header)
+		self.gc_header = list(inputs_df.columns[1:])
+		self.gc_header.insert(0,"GC Time Stamp")
+		self.gc_header.insert(0,"GC Run ID")
+		self.gc_header.insert(0,self.gc_module_name)
+		self.gc_header.insert(0, "Reaction Name")
+		self.gc_log_writer = LogWriter.from_settings(self.gc_logfile_location,self.gc_header,settings_json["logger"],flush_rows=1) #gc rows are rare. Write each one out immediately
+		self.live_analysis = None
+		if settings_json[self.gc_module_name].get("Live Analysis",{}).get("Enabled","False") == "True": #parse each gc run as soon as it is logged
+			self.live_analysis = LiveAnalysis(self.rxn_dirname,self.rxn_name,settings_json,self.gc_header,mock=mock)
 	
 
 		#set up reaction time and counters
-		self.setpoint_switch_times = [60*float(i) for i in inputs_df["Control Point Name"][4:]] #convert from min to sec
-		self.setpoint_switch_times.append(0) #The final setpt is an end setpt. No need to continue logging once this occurs. Just shut program off.
-		self.start_time = time.time()
+		self.setpoint_switch_times = np.append(60*self.setpt_matrix["Control Point Name"].to_numpy(dtype=float),0) #convert from min to sec. The final setpt is an end setpt. No need to continue logging once this occurs. Just shut program off.
+
+		#compile the recipe once so step switches and dynamic updates are array lookups instead of pandas indexing
+		self.setpt_array = self.setpt_matrix.iloc[:,1:].to_numpy(dtype=float) #rows = recipe steps, columns = subdevices
+		self.setpt_columns = {subdev_name : i for (i,subdev_name) in enumerate(self.setpt_matrix.columns[1:])} #subdevice name -> column of setpt_array
+		self.device_setpt_columns = {} #device name -> [(subdevice name, column of setpt_array)] in the device's subdevice order
+		self.device_dynamic_subdevices = {} #device name -> dynamic subdevices of that device
+		dynamic_subdevice_set = set(self.dynamic_subdevices)
+		for device_name in self.devices.keys():
+			subdevice_names = list(self.devices[device_name].get_subdevice_names())
+			self.device_setpt_columns[device_name] = [(subdev_name,self.setpt_columns[subdev_name]) for subdev_name in subdevice_names]
+			self.device_dynamic_subdevices[device_name] = [subdev_name for subdev_name in subdevice_names if subdev_name in dynamic_subdevice_set]
+		self.start_time = rxn_clock.now()
 		self.setpoint_switch_time = 0
 		self.current_sp = -1
 		self.next_sp = 0
 		self.prev_log_time = 0
+		self.snapshot = None #DeviceSnapshot from the most recent read of all devices
 
 
-	def set_setpts(self,only_dynamic=False):
+	async def set_setpts(self,only_dynamic=False):
 
 
 		if only_dynamic: #only changing subdevices that are dynamic controlled, i.e. we're in the middle of a rxn recipe step
-			for device_name in self.devices.keys():
-				for subdevice_name in self.devices[device_name].get_subdevice_names():
-					if subdevice_name in self.dynamic_subdevices:
-						if self.devices[device_name].update_sp(subdevice_name):							
-							pass
-						else:
-							self.set_emergency_sps()
-							print("Emergency! Subdevice {} should return True if it succesfully takes its given SP [here: {}], but subdevice returned False.".format(subdevice_name,self.setpt_matrix[subdevice_name].iloc[self.next_sp]))
+			failed_subdevices = await self.for_each_device(self.update_device_sps)
 		else:
-			for device_name in self.devices.keys():
-				for subdevice_name in self.devices[device_name].get_subdevice_names():
-					
-					if self.devices[device_name].set_sp(subdevice_name,self.setpt_matrix[subdevice_name].iloc[self.next_sp]): #device should return whether setpt took successfully or not
-						pass
-					else:
-						print("Emergency! Subdevice {} should return True if it succesfully takes its given SP [here: {}], but subdevice returned False.".format(subdevice_name,self.setpt_matrix[subdevice_name].iloc[self.next_sp]))
-						self.set_emergency_sps()
-			self.setpoint_switch_time = time.time()
+			failed_subdevices = await self.for_each_device(self.set_device_sps)
+			self.setpoint_switch_time = rxn_clock.now()
+		for failed in failed_subdevices:
+			for subdevice_name in failed:
+				print("Emergency! Subdevice {} should return True if it succesfully takes its given SP [here: {}], but subdevice returned False.".format(subdevice_name,self.setpt_array[self.next_sp,self.setpt_columns[subdevice_name]]))
+		self.snapshot = None #setpoints changed. Readings taken before this are stale
+		if any(failed_subdevices):
+			await self.set_emergency_sps()
+		if not only_dynamic:
 			self.current_sp += 1
 			self.next_sp += 1	
 
-	def log(self,headers=True):
-		self.prev_log_time = time.time()
+	def update_device_sps(self,device_name): #runs on the device's port thread. Returns subdevices that failed to update
+		failed = []
+		for subdevice_name in self.device_dynamic_subdevices[device_name]:
+			if not self.devices[device_name].update_sp(subdevice_name):
+				failed.append(subdevice_name)
+		return failed
+
+	def set_device_sps(self,device_name): #runs on the device's port thread. Returns subdevices that failed to take their SP
+		failed = []
+		setpts = self.setpt_array[self.next_sp]
+		for (subdevice_name,column) in self.device_setpt_columns[device_name]:
+			if not self.devices[device_name].set_sp(subdevice_name,setpts[column]): #device should return whether setpt took successfully or not
+				failed.append(subdevice_name)
+		return failed
+
+	def read_device_sps(self,device_name):
+		return [self.devices[device_name].get_sp(subdevice_name) for subdevice_name in self.devices[device_name].get_subdevice_names()]
+
+	def read_device_pvs(self,device_name):
+		return [self.devices[device_name].get_pv(subdevice_name) for subdevice_name in self.devices[device_name].get_subdevice_names()]
+
+	async def for_each_device(self,fn):
+		#runs fn(device_name) for every device, concurrently across ports. Results are returned in device order.
+		return await asyncio.gather(*[self.dispatcher.run(device_name,fn,device_name) for device_name in self.devices.keys()])
+
+	async def take_snapshot(self):
+		#reads every SP and PV once. log, is_emergency and create_gc_log all work off the latest snapshot instead of re-reading the bus
+		read_time = rxn_clock.now()
+		readings = await self.for_each_device(self.read_device_sps_and_pvs)
+		self.snapshot = DeviceSnapshot(read_time,[(device_name,list(self.devices[device_name].get_subdevice_names())) for device_name in self.devices.keys()],readings)
+		return self.snapshot
+
+	async def log(self,headers=True):
+		snapshot = await self.take_snapshot()
+		self.prev_log_time = snapshot.read_time
 		
 		#add time and reaction name to log
-		self.log_values = [time.ctime(self.prev_log_time) ,self.rxn_name]
+		self.log_values = [rxn_clock.ctime(self.prev_log_time) ,self.rxn_name]
 
-		#add all setpoints to log
-		for device_name in self.devices.keys():
-			for subdevice_name in self.devices[device_name].get_subdevice_names():
-				self.log_values.append(self.devices[device_name].get_sp(subdevice_name))
-		for device_name in self.devices.keys():
-			for subdevice_name in self.devices[device_name].get_subdevice_names():
-				self.log_values.append(self.devices[device_name].get_pv(subdevice_name))
+		#add all setpoints to log, then all pvs
+		self.log_values.extend(snapshot.sps)
+		self.log_values.extend(snapshot.pvs)
 		#write to logfile
-		with open(self.logfile_location,'a') as f:
-			csv_writer = csv.writer(f, delimiter=',', lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
-			csv_writer.writerow(self.log_values)
+		self.log_writer.writerow(self.log_values)
+		if self.binary_log_writer is not None:
+			self.binary_log_writer.writerow(self.prev_log_time,self.log_values[2:])
 
 		#Display
 		print("=================== PVs ====================")
@@ -166,86 +212,282 @@ class Reaction():
 		else:
 			print(tabulate.tabulate([self.log_values],floatfmt=".2f"))			
 		print("\n")
+
+	def read_device_sps_and_pvs(self,device_name):
+		device = self.devices[device_name]
+		if hasattr(device,"read_all_pvs"): #device can read all of its subdevices in one bulk transaction
+			readings = device.read_all_pvs()
+			return (self.read_device_sps(device_name),[readings[subdevice_name]["PV"] for subdevice_name in device.get_subdevice_names()])
+		return (self.read_device_sps(device_name),self.read_device_pvs(device_name))
 	
-	def set_emergency_sps(self):
+	async def set_emergency_sps(self):
 		print("\nSetting emergency setpoints...\n")
 		for device_name in self.devices.keys():
 			for subdevice_name in self.devices[device_name].get_subdevice_names():
 				emergency_sp = self.devices[device_name].get_emergency_sp(subdevice_name)
-				print(self.devices[device_name].set_sp(subdevice_name,emergency_sp))
-		time.sleep(5)
-		self.log()
+				print(await self.dispatcher.run(device_name,self.devices[device_name].set_sp,subdevice_name,emergency_sp))
+		await asyncio.sleep(5)
+		await self.log()
+		self.log_writer.flush(fsync=True)
+		if self.binary_log_writer is not None:
+			self.binary_log_writer.flush(fsync=True)
 		raise IOError("Emergency setpoints set due to IO Error!")
 
-	def create_gc_log(self):
+	async def create_gc_log(self):
 		gc_run_id = None
-		gc_inject_time = time.time()
+		gc_inject_time = rxn_clock.now()
 		
 		self.gc_log_values = [self.rxn_name,self.gc_module_name,gc_run_id,gc_inject_time]
 		#add all setpoints to log
-		for device_name in self.devices.keys():
-			for subdevice_name in self.devices[device_name].get_subdevice_names():
-				self.gc_log_values.append(self.devices[device_name].get_sp(subdevice_name))
+		if self.snapshot is None: #setpoints changed since the last log tick
+			await self.take_snapshot()
+		self.gc_log_values.extend(self.snapshot.sps)
 
 	def log_gc(self):
-		with open(self.gc_logfile_location,'a') as f:
-			csv_writer = csv.writer(f, delimiter=',', lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
-			csv_writer.writerow(self.gc_log_values)	
+		self.gc_log_writer.writerow(self.gc_log_values)
+		if self.live_analysis is not None and self.gc_log_values[2] != -999:
+			self.live_analysis.submit(self.gc_log_values)
+
+	def close_logs(self):
+		self.log_writer.close()
+		self.gc_log_writer.close()
+		if self.binary_log_writer is not None:
+			self.binary_log_writer.close()
+		if self.live_analysis is not None:
+			self.live_analysis.close()
 
 
 	def is_emergency(self):
-		i = 2 #skipping Time and rxn_name log values
+		#checks the snapshot taken by the last log() call
+		for ((device_name,subdevice_name),subdev_sp,subdev_pv) in zip(self.snapshot.subdevices,self.snapshot.sps,self.snapshot.pvs):
+			emergency_values = self.devices[device_name].is_emergency(subdevice_name,self.snapshot.read_time,self.setpoint_switch_time,subdev_sp,subdev_pv)
+			if emergency_values[0] == True: 
+				print("{}.{} in emergency. Current SP: {} Current PV: {}".format(device_name,emergency_values[1],emergency_values[2],emergency_values[3]))
+				return True
+
+	def next_gc_poll_time(self):
+		#gc drivers that know when the next ready check is worth making (injection timers, state watcher) say so
+		if hasattr(self.gc,"next_ready_check"):
+			return self.gc.next_ready_check(self.gc_poll_interval)
+		return rxn_clock.now()+self.gc_poll_interval
+
+	async def gc_call(self,fn,*args):
+		#Uses the GC driver's asyncio version of a request (async_<name>) when it has one. Otherwise the blocking call
+		#runs on the GC's own worker thread
+		async_fn = getattr(self.gc,"async_"+fn.__name__,None)
+		if async_fn is not None:
+			return await async_fn(*args)
+		return await self.dispatcher.run(self.gc_module_name,fn,*args)
 
-		for device_name in self.devices.keys():
-			for subdevice_name in self.devices[device_name].get_subdevice_names():
-				subdev_sp = self.devices[device_name].get_sp(subdevice_name)
-				emergency_values = self.devices[device_name].is_emergency(subdevice_name,self.prev_log_time,self.setpoint_switch_time,subdev_sp,self.log_values[i+self.num_subdevs]) #need to get to PVs, not SPs by adding self.num_subdevs
-				if emergency_values[0] == True: 
-					print("{}.{} in emergency. Current SP: {} Current PV: {}".format(device_name,emergency_values[1],emergency_values[2],emergency_values[3]))
-					return True
-				i += 1
 	def email(self):
 		rxn.set_emergency_sps()
 		print("Switched to emergency setpoints. Make sure you implement this so as to avoid in the future...")
 		raise NotImplementedError()
 
 
+def validate_recipe(inputs_df,settings_json):
+	#Checks a recipe against the settings json in one pass and returns a list of every violation found (empty if the recipe is valid).
+	#Header rows: 0 = units, 1 = emergency setpoint, 2 = parent device name, 3 = recipe start marker. Recipe steps start at row 4.
+	violations = []
+	subdevice_names = list(inputs_df.columns[1:])
+	header = inputs_df.iloc[:4,:]
+	steps = inputs_df.iloc[4:,:]
+	if steps.shape[0] == 0:
+		violations.append("Recipe has no steps")
+
+	#header/config checks (one per subdevice, not per step)
+	subdevice_configs = {}
+	for subdevice_name in subdevice_names:
+		units = header[subdevice_name].iloc[0]
+		emergency_setting = header[subdevice_name].iloc[1]
+		parent_device_name = header[subdevice_name].iloc[2]
+		if pd.isna(pd.to_numeric(emergency_setting,errors='coerce')):
+			violations.append("{}: emergency setpoint {!r} is not numeric".format(subdevice_name,emergency_setting))
+		if parent_device_name not in settings_json:
+			violations.append("{}: parent device {!r} not found in settings".format(subdevice_name,parent_device_name))
+			continue
+		device_config = settings_json[parent_device_name]
+		if subdevice_name not in device_config.get("Subdevices",{}):
+			violations.append("{}: not configured as a subdevice of {}".format(subdevice_name,parent_device_name))
+			continue
+		subdevice_configs[subdevice_name] = device_config["Subdevices"][subdevice_name]
+		if "Units" in subdevice_configs[subdevice_name]: #pandas reads a units cell of "None" as NaN
+			recipe_units = "None" if pd.isna(units) else str(units).strip()
+			if recipe_units != str(subdevice_configs[subdevice_name]["Units"]):
+				violations.append("{}: recipe units {!r} do not match configured units {!r}".format(subdevice_name,recipe_units,subdevice_configs[subdevice_name]["Units"]))
+		if subdevice_configs[subdevice_name].get("Dynamicity") not in ["Static","Dynamic"]:
+			violations.append("{}: Dynamicity must be Dynamic or Static, got {!r}".format(subdevice_name,subdevice_configs[subdevice_name].get("Dynamicity")))
+		if device_config.get("async") not in [0,1]:
+			violations.append("{}: async must be 0 or 1, got {!r}".format(parent_device_name,device_config.get("async")))
+
+	#step checks, vectorized over the whole setpoint matrix
+	numeric_steps = steps.apply(pd.to_numeric,errors='coerce')
+	bad_cells = numeric_steps.isna().to_numpy()
+	for (row,col) in zip(*np.nonzero(bad_cells)):
+		value = steps.iat[row,col]
+		violations.append("Step {} {}: {!r} is {}".format(row+1,steps.columns[col],value,"blank" if pd.isna(value) else "not numeric"))
+
+	durations = numeric_steps.iloc[:,0].to_numpy(dtype=float)
+	for row in np.nonzero(durations < 0)[0]:
+		violations.append("Step {}: negative duration {}".format(row+1,durations[row]))
+
+	max_settings = np.array([float(subdevice_configs[name]["Max Setting"]) if name in subdevice_configs and subdevice_configs[name].get("Max Setting","None") != "None" else np.inf for name in subdevice_names])
+	setpts = numeric_steps.iloc[:,1:].to_numpy(dtype=float)
+	for (row,col) in zip(*np.nonzero(setpts > max_settings)):
+		violations.append("Step {} {}: SP {} exceeds max {}".format(row+1,subdevice_names[col],setpts[row,col],max_settings[col]))
+
+	#de-duplicate repeated device-level messages (async is checked once per subdevice)
+	return list(dict.fromkeys(violations))
+
+
+class DeviceSnapshot():
+	#SPs and PVs of every subdevice as read at one point in time. Values are stored in log order (device by device).
+	def __init__(self,read_time,device_subdevices,readings):
+		self.read_time = read_time
+		self.subdevices = [] #(device name, subdevice name) for each value
+		self.sps = []
+		self.pvs = []
+		for ((device_name,subdevice_names),(sps,pvs)) in zip(device_subdevices,readings):
+			self.subdevices.extend([(device_name,subdevice_name) for subdevice_name in subdevice_names])
+			self.sps.extend(sps)
+			self.pvs.extend(pvs)
+
+
+class Dispatcher():
+	#Runs blocking driver calls (serial, Modbus, HTTP) off the event loop. Every physical port gets a single worker thread, so calls
+	#to devices sharing a port stay serialized while devices on different ports (and async device tasks) run concurrently.
+	#With inline=True calls run directly on the event loop thread instead (used by the time-warp clock for mock reactions).
+	def __init__(self,inline=False):
+		self.inline = inline
+		self.executors = {} #port -> single-thread executor
+		self.device_ports = {} #device name -> port
+
+	def add_device(self,device_name,config):
+		port = config.get("port",config.get("IP Address",device_name)) #devices without a port (ex. mock configs) get their own thread
+		self.device_ports[device_name] = port
+		if self.inline:
+			return None
+		if port not in self.executors:
+			self.executors[port] = concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix="port_{}".format(port))
+		return self.executors[port]
+
+	async def run(self,device_name,fn,*args):
+		if self.inline:
+			return fn(*args)
+		return await asyncio.get_running_loop().run_in_executor(self.executors[self.device_ports[device_name]],fn,*args)
+
+	def shutdown(self):
+		for executor in self.executors.values():
+			executor.shutdown(wait=False)
+
+
+class Scheduler():
+	#Deadline-based timer queue for run_inner_rxn_loop. Every named event (step switch, log, gc poll, etc.) is due at an absolute time
+	#and the loop sleeps until the earliest one instead of ticking on fixed sleeps.
+	def __init__(self):
+		self.queue = [] #heap of (due time, sequence number, event name)
+		self.deadlines = {} #event name -> sequence number of its live heap entry. Rescheduling an event leaves a stale entry behind that is skipped.
+		self.counter = 0
+		self.wakeup = asyncio.Event() #set whenever the queue changes so a sleeping next_event() re-evaluates its deadline
+
+	def schedule(self,event_name,due_time):
+		self.counter += 1
+		self.deadlines[event_name] = self.counter
+		heapq.heappush(self.queue,(due_time,self.counter,event_name))
+		self.wakeup.set()
+
+	def cancel(self,event_name):
+		self.deadlines.pop(event_name,None)
+
+	def is_scheduled(self,event_name):
+		return event_name in self.deadlines
+
+	async def next_event(self):
+		expired_entry = None #heap entry whose wait last timed out
+		while True:
+			self.wakeup.clear()
+			while self.queue and self.deadlines.get(self.queue[0][2]) != self.queue[0][1]: #drop cancelled/rescheduled entries
+				heapq.heappop(self.queue)
+
+			if not self.queue: #nothing due. Sleep until something gets scheduled
+				await self.wakeup.wait()
+				continue
+
+			(due_time,counter,event_name) = self.queue[0]
+			delay = due_time - rxn_clock.now()
+			if delay <= 0 or self.queue[0] == expired_entry: #event loop timers can fire a hair (< clock resolution) before due_time
+				heapq.heappop(self.queue)
+				del self.deadlines[event_name]
+				return event_name
+			try:
+				await asyncio.wait_for(self.wakeup.wait(),delay)
+			except asyncio.TimeoutError:
+				expired_entry = (due_time,counter,event_name)
+
+
+def wake_gc(scheduler):
+	#moves a pending gc poll up to now
+	if scheduler.is_scheduled("gc"):
+		scheduler.schedule("gc",rxn_clock.now())
+
+
 async def run_inner_rxn_loop(rxn):
 
 	print("Starting reaction.")
 
 	#beginning reaction
 	print("\nSwitching setpoints...")
-	rxn.set_setpts()
+	await rxn.set_setpts()
 	print("Setpoints switched.\n")
 
+	scheduler = Scheduler()
+	scheduler.schedule("step",rxn.setpoint_switch_time+rxn.setpoint_switch_times[rxn.current_sp])
+	scheduler.schedule("log",rxn_clock.now())
+	scheduler.schedule("gc",rxn_clock.now())
+	if len(rxn.dynamic_subdevices) > 0:
+		scheduler.schedule("dynamic",rxn_clock.now()+rxn.dynamic_update_interval)
+
+	gc_watcher = None
+	if hasattr(rxn.gc,"watch_state"): #gc driver watches the instrument itself and wakes the gc event once it turns ready
+		gc_watcher = asyncio.create_task(rxn.gc.watch_state(on_ready=lambda : wake_gc(scheduler)))
+	live_analysis_task = None
+	if rxn.live_analysis is not None:
+		live_analysis_task = asyncio.create_task(rxn.live_analysis.run())
+
 	reaction_finished = False
 	while not reaction_finished:
-		#Switch setpoints if time has elapsed
-		if time.time() >= (rxn.setpoint_switch_time+rxn.setpoint_switch_times[rxn.current_sp]):
+		event = await scheduler.next_event()
+
+		if event == "step": #Switch setpoints once the step duration has elapsed
 			print("time is ready for next switch!")
-			print("{} <- curr time sp_switch_time -> {} duration -> {}".format(time.time(),rxn.setpoint_switch_time,rxn.setpoint_switch_times[rxn.next_sp]))
-			if rxn.gc.all_samples_collected():
+			print("{} <- curr time sp_switch_time -> {} duration -> {}".format(rxn_clock.now(),rxn.setpoint_switch_time,rxn.setpoint_switch_times[rxn.current_sp]))
+			if scheduler.is_scheduled("gc log") or not rxn.gc.all_samples_collected():
+				pass #the gc events re-arm the step switch once the last sample of this step has been logged
+			else:
 				print("all_samples_collected")
 				if rxn.next_sp == (len(rxn.setpoint_switch_times)-1):
 					print(reaction_finished)
 					reaction_finished=True
 				else:
 					print("\nSwitching setpoints...")
-					rxn.set_setpts()
+					await rxn.set_setpts()
 					print("Setpoints switched.\n")
-			await asyncio.sleep(5)
-		else:
-			rxn.set_setpts(only_dynamic=True) #update SP for all dynamic subdevices
+					scheduler.schedule("step",rxn.setpoint_switch_time+rxn.setpoint_switch_times[rxn.current_sp])
+					if not scheduler.is_scheduled("gc"): #new step may require new samples
+						scheduler.schedule("gc",rxn_clock.now())
+
+		elif event == "dynamic":
+			await rxn.set_setpts(only_dynamic=True) #update SP for all dynamic subdevices
+			scheduler.schedule("dynamic",rxn_clock.now()+rxn.dynamic_update_interval)
 
-		if time.time() >= (rxn.prev_log_time+rxn.log_interval):
-			rxn.log()
+		elif event == "log":
+			await rxn.log()
 			if rxn.is_emergency():
-				rxn.set_emergency_sps()
+				await rxn.set_emergency_sps()
 				raise NotImplementedError("Emergency! program shutting down. TBD- create a specific Exception class.")
 
 			if rxn.gc_needs_logging:
-				new_run_id = rxn.gc.get_last_run_id()
+				new_run_id = await rxn.gc_call(rxn.gc.get_last_run_id)
 				if new_run_id == -999:
 					rxn.email("Failed to get previous run id!")
 				if new_run_id != rxn.gc.prev_run_id:
@@ -253,28 +495,35 @@ async def run_inner_rxn_loop(rxn):
 					rxn.gc.prev_run_id = new_run_id
 					rxn.log_gc()
 					rxn.gc_needs_logging = False
+			scheduler.schedule("log",rxn.prev_log_time+rxn.log_interval)
+
+		elif event == "gc":
 			if not rxn.gc.all_samples_collected():
-				await asyncio.sleep(2)
-				if rxn.gc.ready():
+				if await rxn.gc_call(rxn.gc.ready):
 					print("\nInjecting new GC sample...")
-					if rxn.gc.inject():
+					if await rxn.gc_call(rxn.gc.inject):
 						print("Injection successful.\n")
-						await asyncio.sleep(75)
-						rxn.create_gc_log()
-						rxn.gc_needs_logging = True
+						scheduler.schedule("gc log",rxn_clock.now()+rxn.gc_log_delay) #gc polling resumes once the injection has been logged
 					else:
 						print("Injection unsuccessful!\n")
-						rxn.email("Unsuccessful GC injection occurred @ {}\n".format(time.ctime(time.time())))
+						rxn.email("Unsuccessful GC injection occurred @ {}\n".format(rxn_clock.ctime()))
+				else:
+					scheduler.schedule("gc",rxn.next_gc_poll_time())
 
-		await asyncio.sleep(5)
+		elif event == "gc log":
+			await rxn.create_gc_log()
+			rxn.gc_needs_logging = True
+			scheduler.schedule("gc",rxn_clock.now())
+			if not scheduler.is_scheduled("step"): #step switch was held back waiting on this sample
+				scheduler.schedule("step",rxn_clock.now())
 
 
-	while not rxn.gc.ready(): #wait for gc to finish up if needed
+	while not await rxn.gc_call(rxn.gc.ready): #wait for gc to finish up if needed
 		await asyncio.sleep(10)
-		rxn.log()
+		await rxn.log()
 
 	if rxn.gc_needs_logging: #finish logging the last gc run
-		new_run_id = rxn.gc.get_last_run_id()
+		new_run_id = await rxn.gc_call(rxn.gc.get_last_run_id)
 		if new_run_id == -999:
 			rxn.email("Failed to get previous run id!")
 		if new_run_id != rxn.gc.prev_run_id:
@@ -283,7 +532,13 @@ async def run_inner_rxn_loop(rxn):
 			rxn.log_gc()
 			rxn.gc_needs_logging = False		
 
+	if gc_watcher is not None:
+		gc_watcher.cancel()
+	if live_analysis_task is not None: #give the last runs a chance to be analyzed
+		await rxn.live_analysis.finish(timeout=rxn.live_analysis.timeout)
+		live_analysis_task.cancel()
 
+	rxn.close_logs()
 	print("Reaction completed. Finished logging.")
 
 
@@ -293,19 +548,36 @@ async def run_rxn(inputs_df,settings_json,rxn_name,rxn_dirname,mock):
 
 	#Establish asynchronous event loop
 	tasks = set()
-	tasks.add(asyncio.create_task(run_inner_rxn_loop(rxn)))
+	rxn_task = asyncio.create_task(run_inner_rxn_loop(rxn))
+	tasks.add(rxn_task)
 	for device_name in rxn.device_parameters.keys():
 		if device_name in rxn.async_devices: #Device is built to handle asynchronous comms. If so it will expose an async_run function
 			tasks.add(asyncio.create_task(rxn.devices[device_name].async_run()))
 
+	#device tasks run forever. Stop them once the reaction itself is over
+	await asyncio.wait([rxn_task])
+	for task in tasks:
+		if not task.done():
+			task.cancel()
 
 	for task in tasks:
 		try:
 			await task
+		except asyncio.CancelledError:
+			pass
 		except Exception:
 			with open(rxn_dirname+"/error_log.txt",'w') as f:
 				traceback_msg = traceback.format_exc()
 				f.write(traceback_msg)
 			print(traceback_msg)
+	for device in rxn.devices.values(): #close connections held by asyncio clients (ex. the GC http session)
+		if hasattr(device,"async_close"):
+			await device.async_close()
+	rxn.dispatcher.shutdown()
+
+	bus_stats = serial_bus.get_utilization()
+	if bus_stats:
+		print("Serial bus utilization:")
+		print(tabulate.tabulate(bus_stats,headers="keys",floatfmt=".2f"))
 
 	
\ No newline at end of file
@@ -1,5 +1,33 @@
-import serial
-import time
+import serial_bus
+
+MEASURE_PARAM = 0 #FLOW-BUS process 1 parameter numbers
+SETPOINT_PARAM = 1
+
+def parse_chained_reply(reply):
+	#Parses a FLOW-BUS ASCII answer to a parameter request (command 02): :LL NN 02 PP [param value]... where a parameter byte
+	#with bit 0x80 set is followed by another parameter of the same process. Only integer (type 0x20, 2 byte) parameters are handled.
+	#Returns (node, {parameter number : raw value}) or None if the reply can't be parsed.
+	reply = reply.strip()
+	try:
+		if not reply.startswith(':'):
+			return None
+		data = bytes.fromhex(reply[1:])
+		if data[0] != len(data)-1 or data[2] != 0x02:
+			return None
+		node = data[1]
+		values = {}
+		i = 4 #skip length, node, command, process
+		while True:
+			param = data[i]
+			if param & 0x60 != 0x20 or i+3 > len(data): #not an integer parameter, or its value is cut off
+				return None
+			values[param & 0x1F] = int.from_bytes(data[i+1:i+3],'big')
+			i += 3
+			if not param & 0x80: #end of chain
+				break
+		return (node,values)
+	except (ValueError,IndexError):
+		return None
 
 class Device():
 	def __init__(self,params,config,mock=False,rxn_dir=None):
@@ -15,21 +43,40 @@ class Device():
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Mock_Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
 		else:
-			#generating the serial connection that each controller will use
-			self.ser = serial.Serial(baudrate=config["baudrate"], timeout=config["timeout"])
-			self.ser.port = config["port"]
-			self.ser.close()
-			self.ser.open()
+			#shared serial bus that each controller on this port will use
+			self.ser = serial_bus.get_bus(config["port"],config["baudrate"],config["timeout"])
 
 			#initializing each controller with its specific max flow, name, etc.
 			for subdev_name in config["Subdevices"].keys():
 				self.subdevices[subdev_name] = Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
 				self.subdevices[subdev_name].set_control_mode(self.ser) #Sets control mode to accept RS-232 setpoints
-				time.sleep(0.25)	
 
 	def get_pv(self,subdev_name):
 		return self.subdevices[subdev_name].get_pv(self.ser)
 
+	def read_all_pvs(self):
+		#Reads measure and setpoint of every node in one round trip. Each node gets one chained request (measure + setpoint),
+		#all requests are written back to back and the replies are matched up by node afterwards.
+		#Returns {subdevice name : {"PV" : measured flow, "SP" : setpoint held by the controller}}
+		if self.ser is None: #mock
+			return {subdev_name : {"PV" : subdev.get_pv(self.ser),"SP" : subdev.get_sp(self.ser)} for (subdev_name,subdev) in self.subdevices.items()}
+
+		replies = {} #node -> {parameter number : raw value}
+		for reply in self.ser.request_many([subdev.chained_read_command() for subdev in self.subdevices.values()]):
+			parsed = parse_chained_reply(reply)
+			if parsed is not None:
+				replies[parsed[0]] = parsed[1]
+
+		readings = {}
+		for (subdev_name,subdev) in self.subdevices.items():
+			node_reply = replies.get(int(subdev.node,16),{})
+			if MEASURE_PARAM in node_reply and SETPOINT_PARAM in node_reply:
+				readings[subdev_name] = {"PV" : subdev.scale_reading(node_reply[MEASURE_PARAM]),"SP" : subdev.scale_reading(node_reply[SETPOINT_PARAM])}
+			else: #missing or garbled reply. Fall back to a single read of this node
+				print("Chained read failed for {}. Reading it on its own.".format(subdev_name))
+				readings[subdev_name] = {"PV" : subdev.get_pv(self.ser),"SP" : subdev.get_sp(self.ser)}
+		return readings
+
 	def get_sp(self,subdev_name):
 		return self.subdevices[subdev_name].get_sp(self.ser)
 
@@ -113,6 +160,13 @@ class Subdevice():
 		return pressure
 
 
+	def chained_read_command(self):
+		#one request for measure (int 0x20, chained 0x80) and setpoint (int 0x21) of process 1
+		return ':09' + self.node + '0401A0012021' + '0121' + '\r\n'
+
+	def scale_reading(self,raw_value):
+		return (float(raw_value)/ 32000) * float(self.max_setting)
+
 	def set_sp(self,ser,setpoint_in):
 		if setpoint_in > 0:
 			setpoint = (float(setpoint_in) / float(self.max_setting)) * 32000
@@ -151,12 +205,9 @@ class Subdevice():
 
 	def comm(self, ser, command):
 		""" Send commands to device and recieve reply """
-		ser.write(command.encode('ascii'))
-		time.sleep(0.1)
-
-		return_string = ser.read(ser.inWaiting())
-		return_string = return_string.decode()
-		return return_string
+		#Replies are one \r\n terminated line. The bus returns as soon as the terminator arrives instead of sleeping a fixed time.
+		#The port timeout is the deadline for the whole reply. A timed-out (partial) reply fails to parse and get_pv retries.
+		return ser.request(command)
 
 	def set_control_mode(self,ser):
 		""" Set the control mode to accept rs232 setpoint """
@@ -2,10 +2,10 @@
 import os
 import json
 import click
-import asyncio
 import shutil
 import pathlib
 import auto_rxn
+import rxn_clock
 import pandas as pd
 import postrun_analysis
 from optparse import OptionParser
@@ -133,6 +133,14 @@ def main(recipe_file,settings_file,recipe_directory,settings_directory,storage_d
 			print("Aborting program! Mock parameter in config file must be a value in {} or {}".format(true_values,false_values))
 			quit()
 
+		#time-warp runs the whole recipe on a virtual clock. Only allowed against mock devices
+		if settings_json["main"].get("time_warp","False") in true_values:
+			if not mock:
+				print("Aborting program! time_warp can only be used for mock reactions")
+				quit()
+			rxn_clock.set_clock(rxn_clock.VirtualClock())
+			click.echo('Time-warp enabled. Reaction will run on a virtual clock.')
+
 		#initialize and begin reaction
 
 
@@ -142,7 +150,7 @@ def main(recipe_file,settings_file,recipe_directory,settings_directory,storage_d
 		click.echo('Subdirectory successfully created and populated.')
 
 
-		asyncio.run(auto_rxn.run_rxn(inputs_df,settings_json,rxn_name,rxn_dirname,mock))
+		rxn_clock.run(auto_rxn.run_rxn(inputs_df,settings_json,rxn_name,rxn_dirname,mock))
 
 if __name__ == "__main__":
 	main()
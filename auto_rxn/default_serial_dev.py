@@ -1,4 +1,4 @@
-import serial
+import serial_bus
 import time
 
 class Device():
@@ -6,6 +6,10 @@ class Device():
 		self.config = config
 		self.params = params
 		self.wait_time = self.config["Wait Time (sec)"]
+		#"Reply Terminator" (ex. "\r\n") lets replies be read up to their end. "None" waits "Reply Wait (sec)" and reads what arrived
+		reply_terminator = self.config.get("Reply Terminator","None")
+		reply_terminator = None if reply_terminator == "None" else reply_terminator.encode('ascii')
+		reply_wait = float(self.config.get("Reply Wait (sec)",0.1))
 
 		self.subdevices = {}
 
@@ -14,15 +18,12 @@ class Device():
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Mock_Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
 		else:
-			#generating the serial connection that each controller will use
-			self.ser = serial.Serial(baudrate=config["baudrate"], timeout=config["timeout"])
-			self.ser.port = config["port"]
-			self.ser.close()
-			self.ser.open()
+			#shared serial bus that each controller on this port will use
+			self.ser = serial_bus.get_bus(config["port"],config["baudrate"],config["timeout"])
 
 			#initializing each controller with its specific max flow, name, etc.
 			for subdev_name in config["Subdevices"].keys():
-				self.subdevices[subdev_name] = Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
+				self.subdevices[subdev_name] = Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name],reply_terminator,reply_wait)
 				self.subdevices[subdev_name].set_control_mode(self.ser) #Sets control mode to accept RS-232 setpoints
 				time.sleep(1)	
 
@@ -74,7 +75,7 @@ class Subdevice():
 ###
 ### This code was primarily adapted from code written by Ethan Young at UW-Madison. Nearly all the credit goes to them.
 ###
-	def __init__(self,name,params,config):
+	def __init__(self,name,params,config,reply_terminator=None,reply_wait=0.1):
 		self.name = name
 		self.units = params["Units"]
 		self.max_setting = str(config["Max Setting"])
@@ -82,6 +83,8 @@ class Subdevice():
 		self.node = '{:02x}'.format(int(config["node"]))
 		self.current_sp = None
 		self.dev_lim = float(config["Dev Lim"])
+		self.reply_terminator = reply_terminator #bytes, or None for a timed read
+		self.reply_wait = reply_wait
 
 	def is_emergency(self,wait_time,pv_read_time,sp_set_time,current_sp,current_pv):
 		if (pv_read_time-sp_set_time > wait_time):
@@ -150,12 +153,9 @@ class Subdevice():
 
 	def comm(self, ser, command):
 		""" Send commands to device and recieve reply """
-		ser.write(command.encode('ascii'))
-		time.sleep(0.1)
-
-		return_string = ser.read(ser.inWaiting())
-		return_string = return_string.decode()
-		return return_string
+		if self.reply_terminator is None: #no known end of reply. Wait and read whatever came back
+			return ser.request_timed(command,self.reply_wait)
+		return ser.request(command,self.reply_terminator) #reads up to the end of the reply instead of sleeping a fixed time
 
 	def set_control_mode(self,ser):
 		""" Set the control mode to accept rs232 setpoint """
@@ -1,8 +1,11 @@
 import minimalmodbus
 import simple_pid
-import serial
-import time
+import serial_bus
 import numpy as np
+import rxn_clock
+import collections
+import modbus_registers
+import stream_filter
 class Device():
 	#If you need to activate port: Go to iTools OPC Server --> Edit --> iTools Control Panel and uncheck whatever port
 	def __init__(self,params,config,mock=False,rxn_dir=None):
@@ -14,6 +17,7 @@ class Device():
 
 		if mock:
 			self.dev = None
+			self.registers = None
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Mock_Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
 		else:
@@ -22,6 +26,9 @@ class Device():
 			self.dev.serial.timeout = self.config["timeout"]
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
+			self.registers = modbus_registers.RegisterCache.from_subdevices(self.dev,self.subdevices,self.config) #block reads of all SP/PV registers
+			for subdev in self.subdevices.values():
+				subdev.registers = self.registers
 
 
 		if "Furnace Temp" in params.keys():
@@ -50,8 +57,6 @@ class Device():
 			self.cascade_controller.auto_mode = False #set cascade controller to manual to start! (overall control mode = AUTO, not CASCADE)
 			self.cascade_controller.sample_time = self.cascade_pid_sample_time
 			self.cascade_controller_max_movement = config["Subdevices"]["Reactor Temp"]["PID_max_movement"] #In degC, the total possible deviation up or down the furnace setpoint can move from its initial value
-			self.prev_reactor_temp = None
-			self.reactor_PV_error_counter = 0
 		else:
 			self.cascade_control_possible = False
 			self.cascade_control_active = False
@@ -72,6 +77,12 @@ class Device():
 	def get_pv(self,subdev_name):
 		return self.subdevices[subdev_name].get_pv(self.dev)
 
+	def read_all_pvs(self):
+		#one block read per register block, then every PV/SP is served from it
+		if self.registers is not None:
+			self.registers.refresh()
+		return {subdev_name : {"PV" : subdev.get_pv(self.dev),"SP" : subdev.get_sp(self.dev)} for (subdev_name,subdev) in self.subdevices.items()}
+
 	def get_sp(self,subdev_name):
 		return self.subdevices[subdev_name].get_sp(self.dev)
 
@@ -120,7 +131,7 @@ class Device():
 					self.cascade_control_active = False 
 				else:
 					self.cascade_control_active = True
-					self.cascade_control_start_time = time.time()
+					self.cascade_control_start_time = rxn_clock.now()
 			elif subdev_name == "Furnace Temp":
 				self.prev_sp = self.get_sp("Furnace Temp")
 		
@@ -145,7 +156,7 @@ class Device():
 
 				#make sure we have no none-type values
 				if self.last_sp_time == None:
-					self.last_sp_time = time.time()
+					self.last_sp_time = rxn_clock.now()
 				if self.subdevices["Furnace Temp"].current_sp == None:
 					self.subdevices["Furnace Temp"].current_sp = self.subdevices["Furnace Temp"].get_sp(self.dev)
 
@@ -172,10 +183,10 @@ class Device():
 								print("Error! Trying to set a negative ramp rate to a higher temperature setpt...")
 								return False
 
-						if time.time()-self.ramp_rate_timer > 60: #never set a new setpoint more often than every min
-							new_sp = self.subdevices["Furnace Temp"].current_sp + (self.get_sp("Ramp Rate") * (time.time() - self.last_sp_time)/60)	
-							print(self.subdevices["Furnace Temp"].current_sp,time.time(),self.last_sp_time)
-							self.ramp_rate_timer = time.time() #reset ramp rate timer (used to avoid sending too many signals to furnace)							
+						if rxn_clock.now()-self.ramp_rate_timer > 60: #never set a new setpoint more often than every min
+							new_sp = self.subdevices["Furnace Temp"].current_sp + (self.get_sp("Ramp Rate") * (rxn_clock.now() - self.last_sp_time)/60)	
+							print(self.subdevices["Furnace Temp"].current_sp,rxn_clock.now(),self.last_sp_time)
+							self.ramp_rate_timer = rxn_clock.now() #reset ramp rate timer (used to avoid sending too many signals to furnace)							
 							if self.current_max_temp_setpt > self.prev_max_setpt:
 								new_sp = min(new_sp,self.current_max_temp_setpt) #want minimum of the two if increasing temp
 
@@ -187,13 +198,14 @@ class Device():
 
 							if new_sp != self.subdevices["Furnace Temp"].current_sp:
 								return self.subdevices[subdev_name].set_sp(self.dev,new_sp)
+							return True #no time has passed since the last ramp step, nothing to set
 						else:
 							return True #no need to re-set setpoint if we've reached our new resting point
 
 			elif self.cascade_control_active: #dynamically setting furnace temp
 				#first check to see if we are ready to enable cascade control. We only do this once the 
 				#controller has had enough time for the inner loop to work its magic
-				if (time.time()-self.cascade_control_start_time) > (abs(self.prev_sp-self.get_sp("Furnace Temp"))/self.reactor_temp_expected_dTdt):
+				if (rxn_clock.now()-self.cascade_control_start_time) > (abs(self.prev_sp-self.get_sp("Furnace Temp"))/self.reactor_temp_expected_dTdt):
 					if self.cascade_controller.auto_mode == False: #if we just reached the time to start cascade control:
 						curr_furnace_sp = self.get_sp("Furnace Temp")
 						self.cascade_controller.output_limits = (curr_furnace_sp-self.cascade_controller_max_movement,curr_furnace_sp+self.cascade_controller_max_movement)
@@ -216,25 +228,11 @@ class Device():
 				try:
 					prev_sp_time = self.subdevices["PV Offset"].last_sp_time
 				except AttributeError:
-					prev_sp_time = time.time() #never called subdevice before
+					prev_sp_time = rxn_clock.now() #never called subdevice before
 					self.subdevices["PV Offset"].last_sp_time = prev_sp_time
 
-				if time.time()-prev_sp_time> 1: #only update this parameter once every 1 second or more.
-					reactor_PV = self.get_pv("Reactor Temp")
-
-					#Sometimes Omega device gives a weirdly high value ex. 5532. In these cases, only treat as error
-					#if you see a high value twice in a row
-					if reactor_PV > 1000: #most likely a weird error. Increment error counter
-						print("Reactor PV of {} reported. Assuming for now this is an error. If it happens twice in a row will throw an emergency.".format(reactor_PV))
-						self.reactor_PV_error_counter += 1
-						if self.reactor_PV_error_counter >= 2:
-							print("2 errors in a row for reactor PV found!")
-							print("Sending the device into error!") #by not doing anything and letting it fail on PV_Offset
-						else:
-							reactor_PV = self.prev_reactor_temp
-					else:
-						self.prev_reactor_temp = reactor_PV
-						self.reactor_PV_error_counter = 0 #reset error counter after a reasonable value
+				if rxn_clock.now()-prev_sp_time> 1: #only update this parameter once every 1 second or more.
+					reactor_PV = self.get_pv("Reactor Temp") #filtered. Spikes (ex. 5532 from the Omega) are dropped, repeated ones come through and fail on PV Offset
 					furnace_PV = self.get_pv("Furnace Temp")
 					furnace_PV_offset = self.get_sp("PV Offset")
 					print("Furnace PV with Offset: {:.5} Reactor PV: {:.5}. Prev Offset: {}".format(furnace_PV,reactor_PV,furnace_PV_offset))
@@ -297,14 +295,16 @@ class Subdevice():
 		self.dev_type = config["Dev Type"]
 		self.config = config
 		self.write_counter = 0
+		self.registers = None #RegisterCache shared by the device's subdevices
+		self.verify_deadline = config.get("Verify Deadline (s)",1.0) #max time for a written SP to show up in the readback
+		self.confirm_latencies = collections.deque(maxlen=100) #seconds from write to confirmed readback
 
+		sensor_break_values = [config["Sensor Break Value"]] if "Sensor Break Value" in config else [] #passed through unfiltered
+		if self.name == "Furnace Temp":
+			self.filter = stream_filter.StreamFilter.from_config(self.name,config,max_value=self.max_setting+200,max_rejections=2,pass_through=sensor_break_values)
 		if self.name == "Reactor Temp":
-			self.ser = serial.Serial(port=self.config["port"],baudrate=self.config["baudrate"])
-			self.PV_arr = []
-			try:
-				self.ser.open()
-			except serial.serialutil.SerialException: #port is already open
-				pass
+			self.ser = serial_bus.get_bus(self.config["port"],self.config["baudrate"],self.config.get("timeout")) #shared with anything else on this port
+			self.filter = stream_filter.StreamFilter.from_config(self.name,config,max_value=1000,max_rejections=1,pass_through=sensor_break_values) #Omega sometimes gives a weirdly high value ex. 5532
 	def is_emergency(self,pv_read_time,sp_set_time,current_sp,current_pv):
 		if (pv_read_time-sp_set_time) > self.wait_time:
 			if self.dev_type == "Change from previous": #Use dev_lim as a minimum change required from previous sp
@@ -330,32 +330,34 @@ class Subdevice():
 			return [False,self.name,current_sp,current_pv]
 
 
+	def read_float(self,dev,address,fresh=False):
+		if self.registers is None:
+			return dev.read_float(address)
+		return self.registers.read_float(address,fresh)
+
+	def verify_sp(self,dev,matches):
+		#polls the SP readback until matches(readback) or the verify deadline passes, instead of sleeping a fixed time
+		(dev_sp,latency) = modbus_registers.poll_until(lambda : self.read_float(dev,self.sp_read_address,fresh=True),matches,self.verify_deadline)
+		if latency is not None:
+			self.confirm_latencies.append(latency)
+		return dev_sp
+
 	def get_pv(self,dev):
 		if self.name =="Furnace Temp":
-			return dev.read_float(self.pv_read_address)
+			return self.filter.update(self.read_float(dev,self.pv_read_address))
 		elif self.name == "Reactor Temp":
-			self.ser.write("F\r".encode())
-			time.sleep(0.1)
+			reply = self.ser.request("F\r")
 			try: 
-				read_val = self.ser.readline().decode().rstrip()
+				read_val = reply.rstrip()
 				read_val = read_val.replace('>','')
 				read_val_degC = 5/9 * (float(read_val)-32) #convert F to C
-				if len(self.PV_arr) < 1: #average 1 values
-					self.PV_arr.append(read_val_degC)
-
-				else:
-					self.PV_arr.pop(0)
-					self.PV_arr.append(read_val_degC)
-
-				return sum(self.PV_arr)/len(self.PV_arr)
-
 			except:
-				print("PV read error!!!!")
-				try:
-					print("Val from thermocouple is {}".format(read_val))
-					return -200
-				except:
-					return -200
+				print("PV read error!!!! Val from thermocouple is {}".format(reply))
+				read_val_degC = None
+			value = self.filter.update(read_val_degC)
+			if value is None: #no good reading to fall back on
+				return -200
+			return value
 		elif self.name == "PV Offset":
 			return self.get_sp(dev)
 		elif self.name == "Ramp Rate":
@@ -370,18 +372,18 @@ class Subdevice():
 				curr_sp = self.get_sp(dev)
 				if sp_value != curr_sp:
 						dev.write_float(self.sp_write_address,sp_value)
+						self.invalidate(self.sp_read_address) #read the new SP back from the device, not the cache
 						self.write_counter += 1
 						print("Write Counter: {}".format(self.write_counter))
 				else:
 					print("New SP {} is same as current SP {} for furnace subdevice {}. Not re-writing value.".format(sp_value,curr_sp,self.name))
-				time.sleep(.5)
-				dev_sp = self.get_sp(dev)
+				dev_sp = self.verify_sp(dev,lambda readback : abs(abs(readback) - abs(sp_value))<=.01)
 				if abs(abs(dev_sp) - abs(sp_value))>.01: #if deviating by more than .01 the setpoint did not take
 					print("SP did not take! Device SP: {} Requested SP: {}".format(dev_sp,sp_value))
 					return False
 				else:
 					self.prev_sp = self.current_sp
-					self.last_sp_time = time.time()
+					self.last_sp_time = rxn_clock.now()
 					self.current_sp = sp_value
 					return True
 			elif self.name == "Ramp Rate" : 
@@ -396,14 +398,14 @@ class Subdevice():
 		else:
 			if self.name == "PV Offset" : 
 				dev.write_float(self.sp_write_address,self.max_setting) #sometimes reactor PV will spike. just use max setting for offset
-				time.sleep(.5)
-				dev_sp = self.get_sp(dev)
+				self.invalidate(self.sp_read_address)
+				dev_sp = self.verify_sp(dev,lambda readback : readback == sp_value)
 				if dev_sp != sp_value:
 					print("SP did not take! Device SP: {} Requested SP: {}".format(dev_sp,sp_value))
 					return False
 				else:
 					self.prev_sp = self.current_sp
-					self.last_sp_time = time.time()
+					self.last_sp_time = rxn_clock.now()
 					self.current_sp = sp_value
 					return True
 			else:
@@ -413,15 +415,19 @@ class Subdevice():
 
 	def get_sp(self,dev):
 		if self.name == "Furnace Temp":
-			return dev.read_float(self.sp_read_address)
+			return self.read_float(dev,self.sp_read_address)
 		elif self.name == "Reactor Temp":
 			return self.current_sp
 		elif self.name == "Ramp Rate": 
 			return self.current_sp
 		elif self.name == "PV Offset":
-			return dev.read_float(self.sp_read_address)
+			return self.read_float(dev,self.sp_read_address)
 		else:
 			print("Trying to get SP for {} which is not implemented yet!".format(self.name))
 
+	def invalidate(self,address):
+		if self.registers is not None:
+			self.registers.invalidate(address)
+
 	def get_max_setting(self):
 		return self.max_setting
\ No newline at end of file
@@ -2,14 +2,19 @@ import minimalmodbus
 import asyncio
 import simple_pid
 import serial
-import time
 import numpy as np
 from labjack import ljm
 from simple_pid import PID
 import os
-import csv
 import tabulate 
 import copy
+import concurrent.futures
+from log_writer import LogWriter
+import rxn_clock
+import collections
+import modbus_registers
+import labjack_stream
+import stream_filter
 class Device():
 	#If you need to activate port: Go to iTools OPC Server --> Edit --> iTools Control Panel and uncheck whatever port
 	def __init__(self,params,config,mock=False,rxn_dir=None):
@@ -19,23 +24,30 @@ class Device():
 		# self.emergency_flows = {}
 		self.subdevices = {}
 		self.mock = mock
+		self.port_executor = None #set by auto_rxn so blocking calls made from async_run share the port's worker thread
 
 		self.rxn_dirname = rxn_dir
 		self.logfile_location = os.path.join(self.rxn_dirname, "{}.csv".format("6flow_temp_pv_log"))
-		self.logtimer = time.time()
+		self.logtimer = rxn_clock.now()
 		self.log_time_interval = 5 #seconds
 		
-		self.addressbook = {"R1":7020,"R2":7016,"R3":7012,"R4":7008,"R5":7004,"R6":7000}
-		with open(self.logfile_location,'w') as f:
-			csv_writer = csv.writer(f, delimiter=',', lineterminator='\n',quoting=csv.QUOTE_MINIMAL)
-			self.headers = list(self.addressbook.keys())
-			self.headers.insert(0,"Current SP")
-			self.headers.insert(0,"Time")
-			csv_writer.writerow(self.headers) #write header
+		self.addressbook = self.config.get("Reactor Channels",{"R1":7020,"R2":7016,"R3":7012,"R4":7008,"R5":7004,"R6":7000}) #log column -> LabJack register (AIN#_EF_READ_A, degC)
+		self.log_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix="labjack_log") #reactor temperature logging runs beside the furnace loop
+		self.log_future = None
+		reactor_max = self.config["Subdevices"].get("Reactor Temp",{}).get("Max Setting")
+		self.channel_filters = {channel : stream_filter.StreamFilter.from_config(channel,self.config,section="Reactor Channel Filter",min_value=0,
+																					max_value=reactor_max+200 if isinstance(reactor_max,(int,float)) else None,
+																					max_rejections=2,pass_through=[labjack_stream.ERROR_VALUE])
+								for channel in self.addressbook} #logged reactor temperatures get the same spike rejection as the Reactor Temp PV
+		self.headers = list(self.addressbook.keys())
+		self.headers.insert(0,"Current SP")
+		self.headers.insert(0,"Time")
+		self.log_writer = LogWriter.from_settings(self.logfile_location,self.headers,self.config) #write header
 
 
 		if self.mock:
 			self.dev = None
+			self.registers = None
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Mock_Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
 		else:
@@ -44,6 +56,27 @@ class Device():
 			self.dev.serial.timeout = self.config["timeout"]
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
+			self.registers = modbus_registers.RegisterCache.from_subdevices(self.dev,self.subdevices,self.config) #block reads of all SP/PV registers
+			for subdev in self.subdevices.values():
+				subdev.registers = self.registers
+
+		#optional LabJack stream mode. All reactor channels are sampled at a fixed rate instead of polled one value at a time
+		self.stream = None
+		stream_config = self.config.get("Reactor Stream",{})
+		if not self.mock and "Reactor Temp" in self.subdevices and stream_config.get("Enabled","False") in ["True","true","T"]:
+			raw_log_base = None
+			if stream_config.get("Save Raw","False") in ["True","true","T"]:
+				raw_log_base = os.path.join(self.rxn_dirname,"6flow_temp_stream")
+			self.stream = labjack_stream.LabJackStream(self.subdevices["Reactor Temp"].handle,self.addressbook,
+														scan_rate=stream_config.get("Scan Rate (Hz)",100),
+														buffer_seconds=stream_config.get("Buffer (s)",600),
+														scans_per_read=stream_config.get("Scans Per Read",50),
+														thermocouple_type=stream_config.get("Thermocouple Type","K"),
+														raw_log_base=raw_log_base,log_settings=stream_config)
+			self.stream_average = stream_config.get("Average (s)",1.0) #seconds of samples behind each PV
+			self.subdevices["Reactor Temp"].stream = self.stream
+			self.subdevices["Reactor Temp"].stream_average = self.stream_average
+			self.stream.start()
 
 		#Establishing basic booleans to control high-level code functionalities (ramp rate, cascade control, etc.)
 		if "Furnace Temp" in params.keys():
@@ -65,8 +98,6 @@ class Device():
 		print("Ramp rate control available: {}".format(self.ramp_rate_exists))
 		print("Reactor setpoint tracking available: {}".format(self.reactor_temp_exists))
 
-		self.reactor_PV_error_counter = 0
-
 		#setpoint values initialized at current value. See async_run fx for details on implementation
 		self.new_SP = self.subdevices["Furnace Temp"].get_sp(self.dev)
 		self.curr_SP = self.new_SP
@@ -102,6 +133,12 @@ class Device():
 	def get_pv(self,subdev_name):
 		return self.subdevices[subdev_name].get_pv(self.dev)
 
+	def read_all_pvs(self):
+		#one block read per register block, then every PV/SP is served from it
+		if self.registers is not None:
+			self.registers.refresh()
+		return {subdev_name : {"PV" : subdev.get_pv(self.dev),"SP" : subdev.get_sp(self.dev)} for (subdev_name,subdev) in self.subdevices.items()}
+
 	def get_sp(self,subdev_name):
 		return self.subdevices[subdev_name].get_sp(self.dev)
 
@@ -125,30 +162,55 @@ class Device():
 	def get_max_setting(self,subdev_name):
 		return self.subdevices[subdev_name].get_max_setting()
 
+	async def run_blocking(self,fn,*args):
+		#Runs a blocking Modbus/LabJack call without stalling the event loop
+		if self.port_executor is None:
+			return fn(*args)
+		return await asyncio.get_running_loop().run_in_executor(self.port_executor,fn,*args)
+
+	async def async_close(self):
+		#called once the reaction is over. A reactor PV log still running finishes before the LabJack is released
+		self.log_executor.shutdown(wait=True)
+		if self.stream is not None:
+			self.stream.stop()
+		self.log_writer.close()
+		if not self.mock and "Reactor Temp" in self.subdevices:
+			ljm.close(self.subdevices["Reactor Temp"].handle)
+
 	def log_reactor_pv(self):
-		elapsed_time = time.time()-self.logtimer 
+		elapsed_time = rxn_clock.now()-self.logtimer 
 
 		if elapsed_time > self.log_time_interval:
-			Ts = [time.ctime(time.time()),self.curr_SP]
-			dataType = ljm.constants.FLOAT32
-			for i in range(1,7,1):
-				Ts.append(ljm.eReadAddress(self.subdevices["Reactor Temp"].handle, self.addressbook[f'R{i}'], dataType))
-				time.sleep(0.05)
+			Ts = [rxn_clock.ctime(),self.curr_SP]
+			if self.stream is not None:
+				readings = self.stream.means(self.stream_average)
+			else:
+				addresses = list(self.addressbook.values())
+				readings = ljm.eReadAddresses(self.subdevices["Reactor Temp"].handle,len(addresses),addresses,[ljm.constants.FLOAT32]*len(addresses)) #all channels in one request
+			Ts.extend([self.channel_filters[channel].update(reading) for (channel,reading) in zip(self.addressbook,readings)])
 
 			#write to logfile
-			with open(self.logfile_location,'a') as f:
-				csv_writer = csv.writer(f, delimiter=',', lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
-				csv_writer.writerow(Ts)
+			self.log_writer.writerow(Ts)
 
 			#Display
 			print("=============== Temperatures ===============")
 			print(tabulate.tabulate([Ts],headers=self.headers,floatfmt=".2f"))
 			print("\n")
-			self.logtimer = time.time()
+			self.logtimer = rxn_clock.now()
 		else:
 			pass
 
 
+	def start_reactor_pv_log(self):
+		#Logs the reactor temperatures on the labjack log thread so the furnace loop never waits on it.
+		#Skipped while the previous log is still running.
+		if self.log_future is not None:
+			if not self.log_future.done():
+				return
+			if self.log_future.exception() is not None:
+				print("Reactor PV log error: {}".format(self.log_future.exception()))
+		self.log_future = asyncio.get_running_loop().run_in_executor(self.log_executor,self.log_reactor_pv)
+
 	def ready_for_furnace_sp_switch(self):
 		#This method determines whether furnace SP is ready for a switch during reactor PV tracking.
 
@@ -163,7 +225,7 @@ class Device():
 		#Second, run the checks to see whether the reactor PV has stabilized for long enough. 
 		else:
 
-			if time.time() - self.tracker_start < self.tracker_stabilization_time*60: #if sufficient time has not passed
+			if rxn_clock.now() - self.tracker_start < self.tracker_stabilization_time*60: #if sufficient time has not passed
 				print("Waiting on tracker stabilization time. Current Range: {} ".format(abs(max(self.tracker_reactor_pv_register) - min(self.tracker_reactor_pv_register))))
 				return False
 
@@ -228,7 +290,7 @@ class Device():
 
 							else: #ramp initialization logic
 
-								self.ramp_start_time = time.time()
+								self.ramp_start_time = rxn_clock.now()
 								self.ramp_start_temp = self.curr_SP
 								self.ramp_in_progress = True
 
@@ -246,22 +308,22 @@ class Device():
 							self.ramp_in_progress = False
 						else:
 							if self.ramp_start_temp <= self.new_SP: #ramping up:
-								self.curr_SP = self.ramp_start_temp + self.curr_ramp_rate * (time.time() - self.ramp_start_time)/60
+								self.curr_SP = self.ramp_start_temp + self.curr_ramp_rate * (rxn_clock.now() - self.ramp_start_time)/60
 								self.curr_SP = min(self.curr_SP,self.new_SP)
 							else: #ramping down
-								self.curr_SP = self.ramp_start_temp - self.curr_ramp_rate * (time.time() - self.ramp_start_time)/60
+								self.curr_SP = self.ramp_start_temp - self.curr_ramp_rate * (rxn_clock.now() - self.ramp_start_time)/60
 								self.curr_SP = max(self.curr_SP,self.new_SP)
 
 					elif self.tracking_in_progress: #Once ramping is finished, check for tracking: 
 						if self.tracker_start == None:
-							self.tracker_start = time.time() #Start the tracker
+							self.tracker_start = rxn_clock.now() #Start the tracker
 							self.tracker_reactor_pv_register = [] #reinitialize the pv_tracker
 							self.tracker_furnace_pv_register = []
 							self.tracker_time_register = []
 
-						self.tracker_time_register.append(time.time())
-						self.tracker_reactor_pv_register.append(self.get_pv("Reactor Temp")) #each iteration collect a new tracker PV
-						self.tracker_furnace_pv_register.append(self.get_pv("Furnace Temp"))
+						self.tracker_time_register.append(rxn_clock.now())
+						self.tracker_reactor_pv_register.append(await self.run_blocking(self.get_pv,"Reactor Temp")) #each iteration collect a new tracker PV
+						self.tracker_furnace_pv_register.append(await self.run_blocking(self.get_pv,"Furnace Temp"))
 
 
 						#check for bad pv from reactor. If you get one, remove from the array
@@ -287,9 +349,9 @@ class Device():
 
 					elif self.cascade_in_progress: #Execute cascade control if active
 						if self.pid.auto_mode == False: 
-							self.pid.set_auto_mode(True,last_output=self.get_sp("Furnace Temp")) #turn pid on with 0 integral error
+							self.pid.set_auto_mode(True,last_output=await self.run_blocking(self.get_sp,"Furnace Temp")) #turn pid on with 0 integral error
 
-						pv = self.get_pv("Reactor Temp")
+						pv = await self.run_blocking(self.get_pv,"Reactor Temp")
 						if pv < self.min_SP or pv > self.max_SP: #sometimes TC returns a bad reading. In this case, skip it
 							print("Bad thermocouple PV: {}".format(pv))
 						else:
@@ -306,10 +368,10 @@ class Device():
 					if self.mock:
 						self.subdevices["Furnace Temp"].current_sp = self.curr_SP
 					else:
-						self.dev.write_float(self.alt_sp_register,self.curr_SP)
+						await self.run_blocking(self.dev.write_float,self.alt_sp_register,self.curr_SP)
 						if self.prev_curr_SP != self.curr_SP:
 							print (f'Furnace update. Prev Furnace SP: {self.prev_curr_SP}. New Furnace SP: {self.curr_SP}')
-						self.log_reactor_pv()
+						self.start_reactor_pv_log()
 		
 					await asyncio.sleep(.5)
 
@@ -357,12 +419,22 @@ class Subdevice():
 		self.dev_type = config["Dev Type"]
 		self.config = config
 		self.write_counter = 0
+		self.registers = None #RegisterCache shared by the device's subdevices
+		self.verify_deadline = config.get("Verify Deadline (s)",1.0) #max time for a written SP to show up in the readback
+		self.confirm_latencies = collections.deque(maxlen=100) #seconds from write to confirmed readback
 		if self.dev_type == "Sensor Break":
 			self.sensor_break_counter = 0
 			self.sensor_break_value = config["Sensor Break Value"]
 			self.sensor_break_max = config["Sensor Break Max"]
+		sensor_break_values = [config["Sensor Break Value"]] if "Sensor Break Value" in config else [] #never filtered, the emergency check counts them
+		if self.name == "Furnace Temp":
+			self.filter = stream_filter.StreamFilter.from_config(self.name,config,max_value=self.max_setting+200,max_rejections=2,pass_through=sensor_break_values)
 
 		if self.name == "Reactor Temp":
+			self.stream = None #LabJackStream, set by the device when stream mode is on
+			self.stream_average = 1.0
+			self.stream_channel = config.get("Stream Channel","R1") #channel of the Reactor Channels table this PV comes from
+			self.filter = stream_filter.StreamFilter.from_config(self.name,config,min_value=0,max_value=self.max_setting+200,max_rejections=2,pass_through=sensor_break_values) #drops single bad thermocouple readings
 
 
 			self.handle = ljm.openS("T7", "ANY", "ANY")  # T7, Any connection, Any identifier
@@ -413,10 +485,24 @@ class Subdevice():
 			return [False,self.name,current_sp,current_pv]
 
 
+	def read_float(self,dev,address,fresh=False):
+		if self.registers is None:
+			return dev.read_float(address)
+		return self.registers.read_float(address,fresh)
+
+	def verify_sp(self,dev,matches):
+		#polls the SP readback until matches(readback) or the verify deadline passes, instead of sleeping a fixed time
+		(dev_sp,latency) = modbus_registers.poll_until(lambda : self.read_float(dev,self.sp_read_address,fresh=True),matches,self.verify_deadline)
+		if latency is not None:
+			self.confirm_latencies.append(latency)
+		return dev_sp
+
 	def get_pv(self,dev):
 		if self.name =="Furnace Temp":
-			return dev.read_float(self.pv_read_address)
+			return self.filter.update(self.read_float(dev,self.pv_read_address))
 		elif self.name == "Reactor Temp":
+			if self.stream is not None: #command-response AIN reads don't work while streaming
+				return self.filter.update(self.stream.get_mean(self.stream_channel,self.stream_average))
 
 			address = 7020  # Address for AIN10 configured output (degC) #R1
 			#address = 7016  # Address for AIN10 configured output (degC) #R2
@@ -426,7 +512,7 @@ class Subdevice():
 			#address = 7000  # Address for AIN10 configured output (degC) #R6
 			dataType = ljm.constants.FLOAT32
 			result = ljm.eReadAddress(self.handle, address, dataType)
-			return result
+			return self.filter.update(result)
 		elif self.name == "PV Offset":
 			return self.get_sp(dev)
 		elif self.name == "Ramp Rate":
@@ -441,18 +527,18 @@ class Subdevice():
 				curr_sp = self.get_sp(dev)
 				if sp_value != curr_sp:
 						dev.write_float(self.sp_write_address,sp_value)
+						self.invalidate(self.sp_read_address) #read the new SP back from the device, not the cache
 						self.write_counter += 1
 						print("Write Counter: {}".format(self.write_counter))
 				else:
 					print("New SP {} is same as current SP {} for furnace subdevice {}. Not re-writing value.".format(sp_value,curr_sp,self.name))
-				time.sleep(.05)
-				dev_sp = self.get_sp(dev)
+				dev_sp = self.verify_sp(dev,lambda readback : abs(abs(readback) - abs(sp_value))<=.01)
 				if abs(abs(dev_sp) - abs(sp_value))>.01: #if deviating by more than .01 the setpoint did not take
 					print("SP did not take! Device SP: {} Requested SP: {}".format(dev_sp,sp_value))
 					return False
 				else:
 					self.prev_sp = self.current_sp
-					self.last_sp_time = time.time()
+					self.last_sp_time = rxn_clock.now()
 					self.current_sp = sp_value
 					return True
 			elif self.name == "Ramp Rate" : 
@@ -467,14 +553,14 @@ class Subdevice():
 		else:
 			if self.name == "PV Offset" : 
 				dev.write_float(self.sp_write_address,self.max_setting) #sometimes reactor PV will spike. just use max setting for offset
-				time.sleep(.05)
-				dev_sp = self.get_sp(dev)
+				self.invalidate(self.sp_read_address)
+				dev_sp = self.verify_sp(dev,lambda readback : readback == sp_value)
 				if dev_sp != sp_value:
 					print("SP did not take! Device SP: {} Requested SP: {}".format(dev_sp,sp_value))
 					return False
 				else:
 					self.prev_sp = self.current_sp
-					self.last_sp_time = time.time()
+					self.last_sp_time = rxn_clock.now()
 					self.current_sp = sp_value
 					return True
 			else:
@@ -484,15 +570,19 @@ class Subdevice():
 
 	def get_sp(self,dev):
 		if self.name == "Furnace Temp":
-			return dev.read_float(self.sp_read_address)
+			return self.read_float(dev,self.sp_read_address)
 		elif self.name == "Reactor Temp":
 			return self.current_sp
 		elif self.name == "Ramp Rate": 
 			return self.current_sp
 		elif self.name == "PV Offset":
-			return dev.read_float(self.sp_read_address)
+			return self.read_float(dev,self.sp_read_address)
 		else:
 			print("Trying to get SP for {} which is not implemented yet!".format(self.name))
 
+	def invalidate(self,address):
+		if self.registers is not None:
+			self.registers.invalidate(address)
+
 	def get_max_setting(self):
 		return self.max_setting
\ No newline at end of file
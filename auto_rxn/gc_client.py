@@ -0,0 +1,53 @@
+import asyncio
+import json
+import aiohttp
+
+class GCClient():
+	#Asyncio HTTP client for the Inficon GC REST API. One session (a keep-alive connection pool) is used for the whole run and every
+	#request has a timeout. A failed request is retried with an exponential backoff that awaits instead of sleeping, so the reaction
+	#loop and the device tasks keep running while the GC is slow to answer.
+	def __init__(self,ip,timeout=10,retries=3,backoff=0.5,max_backoff=8):
+		self.base_url = 'http://' + ip
+		self.timeout = float(timeout) #seconds, per attempt
+		self.retries = int(retries)
+		self.backoff = float(backoff) #seconds before the first retry. Doubles every retry up to max_backoff
+		self.max_backoff = float(max_backoff)
+		self.session = None #created on first use, it has to be made inside the running event loop
+		self.num_requests = 0
+		self.num_retries = 0
+
+	def get_session(self):
+		if self.session is None or self.session.closed:
+			self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout),connector=aiohttp.TCPConnector(limit=4))
+		return self.session
+
+	async def request(self,path,retries=None,as_json=False):
+		#GETs base_url + path and returns (status code, body). body is parsed json if as_json.
+		#Connection errors, timeouts, 5xx replies and undecodable json are retried. Raises IOError once the retries are used up,
+		#except for a 5xx reply on the last attempt, which is returned so the caller can see the status.
+		if retries is None:
+			retries = self.retries
+		delay = self.backoff
+		for attempt in range(retries+1):
+			try:
+				async with self.get_session().get(self.base_url + path) as response:
+					self.num_requests += 1
+					body = await response.text()
+					if response.status >= 500 and attempt < retries:
+						raise aiohttp.ClientResponseError(response.request_info,response.history,status=response.status,message=body[:100])
+					if as_json and response.status < 500:
+						body = json.loads(body)
+					return (response.status,body)
+			except (aiohttp.ClientError,asyncio.TimeoutError,ValueError) as e:
+				error = e
+			if attempt < retries:
+				self.num_retries += 1
+				print("GC request {} failed ({}). Retrying in {} s".format(path,str(error) or repr(error),delay))
+				await asyncio.sleep(delay)
+				delay = min(2*delay,self.max_backoff)
+		raise IOError("GC request {} failed after {} attempts: {}".format(path,retries+1,repr(error)))
+
+	async def close(self):
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
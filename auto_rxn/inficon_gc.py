@@ -1,7 +1,10 @@
 import json
+import asyncio
 import time
 import requests
 import random
+import rxn_clock
+import gc_client
 
 class Device():
 	def __init__(self,params,config,mock=False,rxn_dir=None):
@@ -22,6 +25,19 @@ class Device():
 		else:
 			self.offset_exists=False
 
+		#cached instrument state, kept up to date by watch_state while the loop waits on the GC
+		self.state = None
+		self.state_time = None
+		self.state_poll_interval = config.get("State Poll Interval (s)",2) #seconds between state requests around the expected end of a run
+		self.state_max_poll_interval = config.get("State Max Poll Interval (s)",8) #polling backs off up to this while the instrument stays busy
+		self.state_poll_lead = config.get("State Poll Lead (s)",10) #fast polling starts this long before the run is expected to end
+		self.run_start_time = None #time of the last successful injection
+		self.run_duration = None #injection to ready of the previous run. Used to skip polling while a run can't be done yet
+		self.state_max_age = config.get("State Max Age (s)",2*self.state_poll_interval) #older cached states are fetched again
+		self.ready_fallback_interval = config.get("Ready Fallback Interval (s)",60) #loop still checks this often while the watcher waits
+		self.watch_requested = asyncio.Event() #set while the loop is waiting for the instrument to turn ready
+		self.watching = False
+
 		if self.mock:
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Mock_Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
@@ -29,6 +45,13 @@ class Device():
 		else:
 
 			self.ip = config["IP Address"]
+			self.http_timeout = config.get("HTTP Timeout (s)",10) #seconds
+			self.run_id_retries = config.get("Run ID Retries",10) #the run id json is sometimes not readable right after a run
+			self.http = requests.Session() #keep-alive for the blocking calls made during setup
+			self.client = gc_client.GCClient(self.ip,timeout=self.http_timeout,
+												retries=config.get("HTTP Retries",3),
+												backoff=config.get("HTTP Backoff (s)",0.5),
+												max_backoff=config.get("HTTP Max Backoff (s)",8))
 			self.default_method = config["Default Method"]
 			self.load_method_status_code = self.load_method(self.default_method)
 			if self.load_method_status_code == 500:
@@ -46,24 +69,23 @@ class Device():
 	def get_last_run_id(self):
 		if self.mock:
 			return 'MOCK RUN {}'.format(random.randint(0,10000000))
-		time.sleep(0.05)
 		try:
-			get_request = requests.get('http://' + self.ip + '/v1/lastRun')
+			get_request = self.http.get('http://' + self.ip + '/v1/lastRun',timeout=self.http_timeout)
 			get_request_json = get_request.json()
 			return get_request_json['dataLocation'].split('/')[-1]
 		except json.decoder.JSONDecodeError:
 			print("Unable to decode GC get request: {}".format(get_request.content))
 			print("Going to try again")
 			try_counter = 0
-			while try_counter < 10:
+			while try_counter < self.run_id_retries:
 				time.sleep(2)
 				try:
-					get_request = requests.get('http://' + self.ip + '/v1/lastRun')
+					get_request = self.http.get('http://' + self.ip + '/v1/lastRun',timeout=self.http_timeout)
 					get_request_json = get_request.json()
 					return get_request_json['dataLocation'].split('/')[-1]
 				except:
 					try_counter += 1
-					print("Failed to read json again. Trying {} more times".format(10-try_counter))
+					print("Failed to read json again. Trying {} more times".format(self.run_id_retries-try_counter))
 			return -999
 		except:
 			print("Unknown error trying to read json!!!")
@@ -73,56 +95,175 @@ class Device():
 
 	def ready(self):
 		if self.mock:
-			if self.delay_exists:
-				if time.time() > ((self.get_sp("Delay Time")*60) + self.last_injection_time):
-					return True
-				else:
-					print("Injection delayed. Time until next injection:", round(((self.last_injection_time + self.get_sp("Delay Time")*60 - time.time()) - (self.last_injection_time + self.get_sp("Delay Time")*60 - time.time())%60)/60) , "minutes", round((self.last_injection_time + self.get_sp("Delay Time")*60 - time.time())%60), "seconds")
-					return False
-			else:
-				return True
+			return self.timers_ready(include_offset=False)
 		else:
-			if 'public:ready' in self.get_state(): #Physical GC instrument is ready. Next check our timers.
-				return_value=True
-				if self.delay_exists: #This delays injections to prevent injecting more frequently than every x minutes.
-					if time.time() > (self.get_sp("Delay Time")*60 + self.last_injection_time):
-						pass #no change to return value needed
-					else:
-						print("Injection delayed due to delay time. Time until next injection:", round(((self.last_injection_time + self.get_sp("Delay Time")*60 - time.time()) - (self.last_injection_time + self.get_sp("Delay Time")*60 - time.time())%60)/60) , "minutes", round((self.last_injection_time + self.get_sp("Delay Time")*60 - time.time())%60), "seconds")
-						return_value=False
-				else:
-					pass #ignore delay time. Move on to inject offset
-				if self.offset_exists: #This delays the first injection of a new recipe step for x minutes.
-					if time.time() > (self.get_sp("Injection Offset")*60+self.last_sp_change_time):
-						pass #ready to inject based on offset.
-					else:
-						print("Injection delayed due to injection offset. Time until next injection: {:.4} seconds".format(self.get_sp("Injection Offset")*60-(time.time()-self.last_sp_change_time)))
-						return_value=False
-				return return_value
-			else:
-				return False
+			return self.injection_ready(self.get_state())
+
+	def injection_ready(self,state):
+		#state is the parsed publicConfiguration of the GC
+		if 'public:ready' in state: #Physical GC instrument is ready. Next check our timers.
+			return self.timers_ready()
+		else:
+			return False
+
+	def next_injection_time(self,include_offset=True):
+		#Earliest time the injection timers allow the next injection. Delay Time keeps injections at least x minutes apart,
+		#Injection Offset delays the first injection of a new recipe step for x minutes.
+		next_time = 0
+		if self.delay_exists:
+			next_time = max(next_time,self.last_injection_time + self.get_sp("Delay Time")*60)
+		if self.offset_exists and include_offset:
+			next_time = max(next_time,self.last_sp_change_time + self.get_sp("Injection Offset")*60)
+		return next_time
+
+	def timers_ready(self,include_offset=True):
+		wait_time = self.next_injection_time(include_offset) - rxn_clock.now()
+		if wait_time > 0:
+			print("Injection delayed. Time until next injection: {} minutes {} seconds".format(int(wait_time//60),round(wait_time%60)))
+			return False
+		return True
+
+	def next_ready_check(self,poll_interval):
+		#When the reaction loop should ask ready() again. While the state watcher waits on a busy instrument it wakes the loop
+		#itself (see watch_state), otherwise the check lands just after the injection timers run out or after poll_interval.
+		now = rxn_clock.now()
+		if self.watching and self.watch_requested.is_set():
+			return now + self.ready_fallback_interval
+		next_time = self.next_injection_time(include_offset=not self.mock)
+		if next_time > now:
+			return next_time + 0.01 #just past the timer so the check doesn't land a hair early
+		return now + poll_interval
 
 	def get_state(self):
-		get_request = requests.get('http://' + self.ip + '/v1/scm/sessions/system-manager/publicConfiguration').json()
+		get_request = self.http.get('http://' + self.ip + '/v1/scm/sessions/system-manager/publicConfiguration',timeout=self.http_timeout).json()
 		return get_request
 
 	def load_method(self,method_name):
-		get_request = requests.get('http://' + self.ip + '/v1/scm/sessions/system-manager!cmd.loadMethod?methodLocation=/methods/userMethods/'+method_name)
+		get_request = self.http.get('http://' + self.ip + '/v1/scm/sessions/system-manager!cmd.loadMethod?methodLocation=/methods/userMethods/'+method_name,timeout=self.http_timeout)
 		if get_request.status_code == 200:
 			return True
 		else:
 			return False
 
+	#Asyncio versions of the GC requests. Reaction.gc_call uses these instead of the blocking ones above when they exist.
+	async def async_get_last_run_id(self):
+		if self.mock:
+			return self.get_last_run_id()
+		try:
+			(status,body) = await self.client.request('/v1/lastRun',retries=self.run_id_retries,as_json=True)
+			return body['dataLocation'].split('/')[-1]
+		except (IOError,KeyError,TypeError,AttributeError) as e:
+			print("Unable to get last GC run id: {}".format(repr(e)))
+			return -999
+
+	async def async_ready(self):
+		if self.mock:
+			return self.ready()
+		state = self.get_cached_state()
+		if state is None:
+			try:
+				state = await self.refresh_state()
+			except IOError as e: #GC not answering. Treat as not ready and poll again later
+				print(e)
+				return False
+		if 'public:ready' not in state:
+			self.watch_requested.set() #let the watcher poll until the instrument turns ready
+		return self.injection_ready(state)
+
+	async def refresh_state(self):
+		self.state = await self.async_get_state()
+		self.state_time = rxn_clock.now()
+		return self.state
+
+	def get_cached_state(self):
+		#last state fetched, or None if there isn't a recent one
+		if self.state is None or rxn_clock.now() - self.state_time > self.state_max_age:
+			return None
+		return self.state
+
+	def state_poll_delay(self,backoff_interval):
+		#Seconds until the watcher's next state request. Once the length of a run is known, requests are skipped until state_poll_lead
+		#seconds before the current run should end and are state_poll_interval apart around that time. Otherwise (first run, or a
+		#run taking longer than the last one) the backoff interval is used.
+		if self.run_start_time is None or self.run_duration is None:
+			return backoff_interval
+		now = rxn_clock.now()
+		fast_poll_start = self.run_start_time + self.run_duration - self.state_poll_lead
+		if now < fast_poll_start:
+			return max(fast_poll_start - now,self.state_poll_interval)
+		if now < fast_poll_start + 2*self.state_poll_lead:
+			return self.state_poll_interval
+		return backoff_interval
+
+	async def watch_state(self,on_ready=None):
+		#Background task. Idles until the loop finds the instrument busy, then polls the state (see state_poll_delay) and calls
+		#on_ready() as soon as the instrument turns ready, so the injection doesn't wait for the loop's next poll.
+		#While the instrument stays busy the poll interval doubles from state_poll_interval up to state_max_poll_interval.
+		if self.mock: #mock instrument is always ready
+			return
+		self.watching = True
+		try:
+			while True:
+				await self.watch_requested.wait()
+				backoff_interval = self.state_poll_interval
+				while self.watch_requested.is_set():
+					await asyncio.sleep(self.state_poll_delay(backoff_interval))
+					backoff_interval = min(2*backoff_interval,self.state_max_poll_interval)
+					try:
+						state = await self.refresh_state()
+					except IOError as e:
+						print(e)
+						continue
+					if 'public:ready' in state:
+						if self.run_start_time is not None:
+							self.run_duration = self.state_time - self.run_start_time
+							self.run_start_time = None
+						self.watch_requested.clear()
+						if on_ready is not None:
+							on_ready()
+		finally:
+			self.watching = False
+
+	async def async_get_state(self):
+		(status,body) = await self.client.request('/v1/scm/sessions/system-manager/publicConfiguration',as_json=True)
+		return body
+
+	async def async_load_method(self,method_name):
+		(status,body) = await self.client.request('/v1/scm/sessions/system-manager!cmd.loadMethod?methodLocation=/methods/userMethods/'+method_name)
+		return status == 200
+
+	async def async_inject(self):
+		if self.mock:
+			return self.inject()
+		try:
+			(status,body) = await self.client.request('/v1/scm/sessions/system-manager!cmd.run',retries=0) #never retried, the first request may have started a run
+		except IOError as e:
+			print(e)
+			return False
+		self.state = None #the instrument is running now, don't trust the cached state
+		if status == 200:
+			self.run_start_time = rxn_clock.now()
+			self.subdevices["Number of Samples"].num_injections += 1
+			self.last_injection_time = rxn_clock.now()
+			return True
+		else: #Status code of 500 returned if injection unsuccessful
+			return False
+
+	async def async_close(self):
+		if not self.mock:
+			await self.client.close()
+			self.http.close()
+
 	def inject(self):
 		if self.mock:
 			self.subdevices["Number of Samples"].num_injections += 1
-			self.last_injection_time = time.time()
+			self.last_injection_time = rxn_clock.now()
 			return True
 		else:
-			get_request = requests.get('http://' + self.ip + '/v1/scm/sessions/system-manager!cmd.run')
+			get_request = self.http.get('http://' + self.ip + '/v1/scm/sessions/system-manager!cmd.run',timeout=self.http_timeout)
 			if get_request.status_code == 200:
 				self.subdevices["Number of Samples"].num_injections += 1 
-				self.last_injection_time = time.time()
+				self.last_injection_time = rxn_clock.now()
 				return True		
 			else: #Status code of 500 returned if injection unsuccessful
 				return False
@@ -136,7 +277,7 @@ class Device():
 
 	def set_sp(self,subdev_name,sp_value):
 		if subdev_name == "Injection Offset":
-			self.last_sp_change_time=time.time()
+			self.last_sp_change_time=rxn_clock.now()
 			print(f'New injection offset time: {self.last_sp_change_time}')
 		return self.subdevices[subdev_name].set_sp(sp_value)
 
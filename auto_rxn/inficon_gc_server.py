@@ -0,0 +1,225 @@
+"""Local stand-in for the Inficon GC REST API, for testing the GC driver and postrun_analysis without the instrument."""
+import os
+import copy
+import json
+import time
+import uuid
+import random
+import datetime
+import threading
+import click
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SESSION_PATH = "/v1/scm/sessions/system-manager"
+FAILURE_MODES = ["error","garbage","drop"] #500 response, body that isn't json, connection closed without a response
+
+def make_peaks(peak_table):
+	#{label : [area, retention time]} -> peak list in the runData format
+	peaks = []
+	for (label,(area,top)) in peak_table.items():
+		peaks.append({"label" : label, "area" : area, "top" : top, "start" : top-0.5, "end" : top+0.5, "height" : area/10})
+	return peaks
+
+
+class GCSimulator():
+	#Instrument state. One run at a time: cmd.run starts a run that lasts run_duration seconds, during which the state is
+	#"public:running" and its runData isn't available yet. Run data is the template with every labelled peak area scaled by
+	#random noise, generated from a per-run seed so repeated requests for a run get the same data.
+	def __init__(self,template,run_duration=60,peak_noise=0.02,peak_table=None):
+		self.template = template
+		if peak_table is not None: #replace the template peaks with a synthetic table ({detector : {label : [area, retention time]}})
+			self.template = copy.deepcopy(template)
+			for (detector,table) in peak_table.items():
+				self.template["detectors"][detector]["analysis"]["peaks"] = make_peaks(table)
+		self.run_duration = float(run_duration)
+		self.peak_noise = float(peak_noise)
+		self.method = template.get("methodName")
+		self.runs = {} #run id -> (start time, seed)
+		self.run_order = []
+		self.lock = threading.Lock()
+		self.add_run(time.time()-self.run_duration) #the instrument always has a last run
+
+	def add_run(self,start_time):
+		run_id = str(uuid.uuid4())
+		self.runs[run_id] = (start_time,random.randrange(2**32))
+		self.run_order.append(run_id)
+		return run_id
+
+	def is_running(self):
+		(start_time,seed) = self.runs[self.run_order[-1]]
+		return time.time() - start_time < self.run_duration
+
+	def get_state(self):
+		with self.lock:
+			if self.is_running():
+				return {"public:running" : {"runId" : self.run_order[-1], "method" : self.method}}
+			return {"public:ready" : {"method" : self.method}}
+
+	def start_run(self):
+		#returns the new run id, or None if a run is still in progress
+		with self.lock:
+			if self.is_running():
+				return None
+			return self.add_run(time.time())
+
+	def load_method(self,method_location):
+		with self.lock:
+			if self.is_running():
+				return False
+			self.method = method_location.split('/')[-1]
+			return True
+
+	def get_last_run_id(self):
+		with self.lock:
+			return self.run_order[-1]
+
+	def get_run_data(self,run_id):
+		#None if the run doesn't exist or hasn't finished
+		with self.lock:
+			if run_id not in self.runs:
+				return None
+			(start_time,seed) = self.runs[run_id]
+		if time.time() - start_time < self.run_duration:
+			return None
+		rng = random.Random(seed)
+		run_data = copy.deepcopy(self.template)
+		for detector in run_data["detectors"].values():
+			for peak in detector["analysis"]["peaks"]:
+				if "label" in peak:
+					peak["area"] = peak["area"]*(1 + self.peak_noise*rng.gauss(0,1))
+		run_data["$id"] = run_id
+		run_data["methodName"] = self.method
+		run_data["runTimeStamp"] = datetime.datetime.fromtimestamp(start_time,datetime.timezone.utc).isoformat().replace("+00:00","Z")
+		return run_data
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1" #keep-alive, like the instrument
+
+	def do_GET(self):
+		server = self.server
+		server.count_request()
+		if server.latency > 0:
+			time.sleep(max(0,random.gauss(server.latency,server.latency_jitter)))
+		if server.failure_rate > 0 and random.random() < server.failure_rate:
+			failure = random.choice(server.failure_modes)
+			server.count_failure(failure)
+			if failure == "drop":
+				self.close_connection = True
+				return
+			if failure == "garbage" and "!cmd." not in self.path: #commands only report a status
+				return self.respond(200,"<html>busy</html>",content_type="text/html")
+			return self.respond(500,json.dumps({"error" : "injected failure"}))
+
+		url = urlparse(self.path)
+		sim = server.simulator
+		if url.path == "/v1/lastRun":
+			return self.respond_json({"dataLocation" : "/v1/runData/" + sim.get_last_run_id()})
+		elif url.path.startswith("/v1/runData/"):
+			run_data = sim.get_run_data(url.path.split('/')[-1])
+			if run_data is None:
+				return self.respond(404,json.dumps({"error" : "run not found or not finished"}))
+			return self.respond_json(run_data)
+		elif url.path == SESSION_PATH + "/publicConfiguration":
+			return self.respond_json(sim.get_state())
+		elif url.path == SESSION_PATH + "!cmd.run":
+			run_id = sim.start_run()
+			if run_id is None:
+				return self.respond(500,json.dumps({"error" : "run in progress"}))
+			return self.respond_json({"runId" : run_id})
+		elif url.path == SESSION_PATH + "!cmd.loadMethod":
+			method_location = parse_qs(url.query).get("methodLocation",[""])[0]
+			if not sim.load_method(method_location):
+				return self.respond(500,json.dumps({"error" : "run in progress"}))
+			return self.respond_json({"methodLocation" : method_location})
+		else:
+			return self.respond(404,json.dumps({"error" : "unknown path {}".format(url.path)}))
+
+	def respond_json(self,body):
+		return self.respond(200,json.dumps(body))
+
+	def respond(self,status,body,content_type="application/json"):
+		data = body.encode()
+		self.send_response(status)
+		self.send_header("Content-Type",content_type)
+		self.send_header("Content-Length",str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self,format,*args):
+		if self.server.verbose:
+			super().log_message(format,*args)
+
+
+class GCServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self,address,simulator,latency=0,latency_jitter=0,failure_rate=0,failure_modes=FAILURE_MODES,verbose=False):
+		super().__init__(address,RequestHandler)
+		self.simulator = simulator
+		self.latency = float(latency) #seconds added to every request
+		self.latency_jitter = float(latency_jitter)
+		self.failure_rate = float(failure_rate) #fraction of requests that fail
+		self.failure_modes = list(failure_modes)
+		self.verbose = verbose
+		self.stats_lock = threading.Lock()
+		self.num_requests = 0
+		self.num_failures = {mode : 0 for mode in FAILURE_MODES}
+
+	def count_request(self):
+		with self.stats_lock:
+			self.num_requests += 1
+
+	def count_failure(self,mode):
+		with self.stats_lock:
+			self.num_failures[mode] += 1
+
+
+def start_server(host="127.0.0.1",port=0,template_file=None,peak_table_file=None,run_duration=60,peak_noise=0.02,**server_options):
+	#Starts a stand-in server on a background thread and returns it. port=0 picks a free port (see server.server_address).
+	#Point a GC config at it with "IP Address" : "<host>:<port>".
+	if template_file is None:
+		template_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),"bp_json.json")
+	with open(template_file,'r') as f:
+		template = json.load(f)
+	peak_table = None
+	if peak_table_file is not None:
+		with open(peak_table_file,'r') as f:
+			peak_table = json.load(f)
+	server = GCServer((host,port),GCSimulator(template,run_duration,peak_noise,peak_table),**server_options)
+	threading.Thread(target=server.serve_forever,name="inficon_gc_server",daemon=True).start()
+	return server
+
+
+@click.command()
+@click.option('--host',default='127.0.0.1',help='Interface to listen on.')
+@click.option('--port',default=8080,help='Port to listen on. Use "IP Address" : "host:port" in the GC config.')
+@click.option('--run_duration',default=60.0,help='Seconds a GC run takes.')
+@click.option('--latency',default=0.0,help='Mean seconds added to every request.')
+@click.option('--latency_jitter',default=0.0,help='Standard deviation of the added latency.')
+@click.option('--failure_rate',default=0.0,help='Fraction of requests that fail (0-1).')
+@click.option('--failure_modes',default=",".join(FAILURE_MODES),help='Comma separated failures to pick from: error (500), garbage (non-json body), drop (connection closed).')
+@click.option('--template_file',default=None,help='runData json used as the template for every run. Default is bp_json.json.')
+@click.option('--peak_table_file',default=None,help='Json of {detector : {label : [area, retention time]}} replacing the template peaks.')
+@click.option('--peak_noise',default=0.02,help='Relative standard deviation applied to every peak area.')
+@click.option('--verbose',is_flag=True,help='Print every request.')
+def main(host,port,run_duration,latency,latency_jitter,failure_rate,failure_modes,template_file,peak_table_file,peak_noise,verbose):
+	"""Runs the GC stand-in server until interrupted."""
+	failure_modes = [mode.strip() for mode in failure_modes.split(",") if mode.strip()]
+	for mode in failure_modes:
+		if mode not in FAILURE_MODES:
+			raise ValueError("Unknown failure mode {}. Options are {}".format(mode,FAILURE_MODES))
+	server = start_server(host,port,template_file,peak_table_file,run_duration,peak_noise,
+							latency=latency,latency_jitter=latency_jitter,failure_rate=failure_rate,failure_modes=failure_modes,verbose=verbose)
+	click.echo("GC stand-in listening on {}:{}. Run duration {} s. Ctrl+C to stop.".format(server.server_address[0],server.server_address[1],run_duration))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	server.shutdown()
+	click.echo("Requests: {} Injected failures: {}".format(server.num_requests,server.num_failures))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,155 @@
+import threading
+import atexit
+import numpy as np
+from labjack import ljm
+import rxn_clock
+from log_writer import BinaryLogWriter
+
+EF_READ_A_BASE = 7000 #AIN#_EF_READ_A register of AIN0. Each AIN adds 2 registers
+DEVICE_TEMP_AIN = 14 #internal temperature sensor, used as the thermocouple cold junction
+DEVICE_TEMP_SLOPE = -92.6 #K/V, T7 internal temperature sensor
+DEVICE_TEMP_OFFSET = 467.6 #K
+ERROR_VALUE = -9999 #what the T7 thermocouple EF registers read on an open thermocouple (sensor break)
+THERMOCOUPLE_TYPES = {"B" : 6001, "E" : 6002, "J" : 6003, "K" : 6004, "N" : 6005, "R" : 6006, "S" : 6007, "T" : 6008, "C" : 6009} #ljm tcVoltsToTemp type codes
+
+def ef_register_to_ain(address):
+	#AIN#_EF_READ_A register (as used for command-response thermocouple reads) -> AIN channel number
+	if address < EF_READ_A_BASE or (address-EF_READ_A_BASE) % 2 != 0:
+		raise ValueError("{} is not an AIN#_EF_READ_A register".format(address))
+	return (address-EF_READ_A_BASE)//2
+
+def ain_stream_address(ain):
+	return 2*ain #AIN# voltage register, the one that can be streamed
+
+
+class LabJackStream():
+	#Streams the thermocouple voltages of all configured channels (plus the cold junction sensor) at a fixed scan rate on a
+	#background thread. Samples are converted to degC and kept in a preallocated ring buffer of buffer_seconds. get_pv reads
+	#decimated means from the buffer, so transients between polls are averaged in instead of missed and no USB round trip
+	#is made per read. Command-response AIN reads are not possible on a T7 while it streams, so all reads go through here.
+	def __init__(self,handle,channels,scan_rate=100,buffer_seconds=600,scans_per_read=50,thermocouple_type="K",raw_log_base=None,log_settings=None):
+		self.handle = handle
+		self.names = list(channels.keys())
+		self.ains = [ef_register_to_ain(address) for address in channels.values()]
+		self.scan_list = [ain_stream_address(ain) for ain in self.ains] + [ain_stream_address(DEVICE_TEMP_AIN)]
+		self.requested_scan_rate = float(scan_rate)
+		self.scan_rate = float(scan_rate) #replaced by the rate the device actually runs at
+		self.scans_per_read = int(scans_per_read)
+		self.tc_type = THERMOCOUPLE_TYPES[thermocouple_type]
+
+		#ring buffer. One row per scan, one column per channel. write_index is where the next scan goes
+		self.buffer_scans = int(buffer_seconds*scan_rate)
+		self.buffer = np.full((self.buffer_scans,len(self.names)),np.nan)
+		self.write_index = 0
+		self.num_scans = 0 #total scans received
+		self.lock = threading.Lock()
+		self.first_data = threading.Event()
+
+		self.num_skipped = 0 #samples the device or LJM dropped (returned as dummy values)
+		self.max_backlog = 0
+		self.error = None
+
+		self.raw_log = None
+		if raw_log_base is not None: #optional high-rate trace of the whole run
+			self.raw_log = BinaryLogWriter.from_settings(raw_log_base,self.names,log_settings or {},metadata={"Scan Rate (Hz)" : self.requested_scan_rate,"Units" : "degC"})
+
+		self.stop_event = threading.Event()
+		self.thread = None
+
+	def start(self):
+		ljm.eWriteName(self.handle,"STREAM_TRIGGER_INDEX",0) #start right away
+		ljm.eWriteName(self.handle,"STREAM_CLOCK_SOURCE",0) #internal clock
+		self.scan_rate = ljm.eStreamStart(self.handle,self.scans_per_read,len(self.scan_list),self.scan_list,self.requested_scan_rate)
+		print("LabJack stream started. Channels: {} Scan Rate: {} Hz".format(self.names,self.scan_rate))
+		self.thread = threading.Thread(target=self.run,name="labjack_stream",daemon=True)
+		self.thread.start()
+		atexit.register(self.stop)
+
+	def run(self):
+		num_cols = len(self.scan_list)
+		try:
+			while not self.stop_event.is_set():
+				(data,device_backlog,ljm_backlog) = ljm.eStreamRead(self.handle) #blocks until scans_per_read scans are in
+				read_time = rxn_clock.now()
+				self.max_backlog = max(self.max_backlog,device_backlog,ljm_backlog)
+				scans = np.asarray(data,dtype=float).reshape(-1,num_cols)
+				temps = self.convert(scans)
+				self.store(temps)
+				if self.raw_log is not None:
+					timestamps = read_time - np.arange(len(temps)-1,-1,-1)/self.scan_rate
+					self.raw_log.write_block(timestamps,temps)
+		except Exception as e:
+			if not self.stop_event.is_set(): #eStreamStop makes a pending read fail, that's not an error
+				self.error = e
+				print("LabJack stream stopped on error: {}".format(e))
+		finally:
+			self.first_data.set() #don't leave readers waiting on a dead stream
+
+	def convert(self,scans):
+		#volts -> degC. The cold junction is the device temperature measured in the same scan
+		skipped = scans == ljm.constants.DUMMY_VALUE
+		self.num_skipped += int(skipped.sum())
+		scans[skipped] = np.nan
+		cj_temps = DEVICE_TEMP_SLOPE*scans[:,-1] + DEVICE_TEMP_OFFSET #K
+		temps = np.full((len(scans),len(self.names)),np.nan)
+		for row in range(len(scans)):
+			if np.isnan(cj_temps[row]):
+				continue
+			for col in range(len(self.names)):
+				if not np.isnan(scans[row,col]):
+					temps[row,col] = ljm.tcVoltsToTemp(self.tc_type,scans[row,col],cj_temps[row]) - 273.15
+		return temps
+
+	def store(self,temps):
+		with self.lock:
+			num_rows = min(len(temps),self.buffer_scans)
+			temps = temps[-num_rows:]
+			end = self.write_index + num_rows
+			if end <= self.buffer_scans:
+				self.buffer[self.write_index:end] = temps
+			else: #wraps around
+				split = self.buffer_scans - self.write_index
+				self.buffer[self.write_index:] = temps[:split]
+				self.buffer[:end-self.buffer_scans] = temps[split:]
+			self.write_index = end % self.buffer_scans
+			self.num_scans += num_rows
+		self.first_data.set()
+
+	def latest(self,seconds):
+		#last seconds of samples, oldest first, as a (scans, channels) array
+		with self.lock:
+			num_rows = min(max(1,int(seconds*self.scan_rate)),self.num_scans,self.buffer_scans)
+			rows = (self.write_index - num_rows + np.arange(num_rows)) % self.buffer_scans
+			return self.buffer[rows]
+
+	def means(self,seconds=1.0):
+		#decimated value per channel: mean over the last seconds of samples, skipped samples ignored
+		if not self.first_data.wait(timeout=2*self.scans_per_read/self.requested_scan_rate + 1):
+			raise IOError("No data from LabJack stream yet")
+		if self.error is not None:
+			raise IOError("LabJack stream is down: {}".format(self.error))
+		samples = self.latest(seconds)
+		counts = np.sum(~np.isnan(samples),axis=0)
+		sums = np.nansum(samples,axis=0)
+		return [float(s/c) if c > 0 else np.nan for (s,c) in zip(sums,counts)]
+
+	def get_mean(self,name,seconds=1.0):
+		return self.means(seconds)[self.names.index(name)]
+
+	def is_running(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def stop(self):
+		if self.thread is None:
+			return
+		self.stop_event.set()
+		try:
+			ljm.eStreamStop(self.handle) #also wakes up a blocked eStreamRead
+		except ljm.LJMError as e:
+			print("Error stopping LabJack stream: {}".format(e))
+		self.thread.join(timeout=5)
+		self.thread = None
+		if self.raw_log is not None:
+			self.raw_log.close()
+		print("LabJack stream stopped. Scans: {} Skipped samples: {} Max backlog: {}".format(self.num_scans,self.num_skipped,self.max_backlog))
+		atexit.unregister(self.stop)
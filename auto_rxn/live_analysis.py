@@ -0,0 +1,149 @@
+import asyncio
+import concurrent.futures
+import os
+import numpy as np
+import tabulate
+import rxn_clock
+import postrun_analysis
+from log_writer import LogWriter
+
+class LiveAnalysis():
+	#Fetches and parses every GC run while the reaction is still going. Reaction.log_gc hands over each logged gc row, a background
+	#task downloads the run (waiting for the GC to finish it), appends its peaks to gc_peaks_<rxn>.csv, and appends a conversion /
+	#selectivity row to gc_results_<rxn>.csv. postrun_analysis.analyze reuses the peaks of every run with a results row, so it only
+	#fetches and parses runs the live analysis didn't finish (those still come from the shared run data cache when it has them).
+	#Conversion is 1 - (reactant/internal standard) relative to the last bypass injection. Selectivities are carbon based:
+	#carbons * area / response factor of each product, as a fraction of the sum over products.
+	def __init__(self,rxn_dirname,rxn_name,settings_json,gc_header,mock=False):
+		self.gc_header = gc_header
+		gc_name = settings_json["main"]["GC Module Name"]
+		gc_config = settings_json[gc_name]
+		config = gc_config.get("Live Analysis",{})
+		self.ip = None if mock else gc_config["IP Address"] #mock runs parse the stored example run
+		self.cache = None if mock else postrun_analysis.get_run_data_cache(rxn_dirname,gc_config)
+		self.http_timeout = gc_config.get("HTTP Timeout (s)",30)
+		self.retry_interval = config.get("Retry Interval (s)",30) #a run can only be downloaded once the GC has finished it
+		self.timeout = 60*config.get("Timeout (min)",30) #give up on a run after this long
+
+		self.reactant = config.get("Reactant","propane")
+		self.reactant_carbons = config.get("Reactant Carbons",3)
+		self.internal_standard = config.get("Internal Standard","nitrogen")
+		self.products = config.get("Products",{"propylene" : 3,"ethylene" : 2,"ethane" : 2,"methane" : 1,"carbon monoxide" : 1,"carbon dioxide" : 1}) #label -> carbon number
+		self.response_factors = config.get("Response Factors",{}) #label -> area per mol (relative). Missing labels use 1
+		self.summary_rows = config.get("Summary Rows",5)
+
+		#same rules postrun_analysis uses to tell bypass from reaction injections
+		subdev_configs = postrun_analysis.get_subdev_configs(settings_json,gc_header)
+		self.temp_columns = [(subdev,subdev_config["T Correction"]) for (subdev,subdev_config) in subdev_configs.items() if subdev_config.get("Analysis Device Type") == "Reactor Temp"]
+		self.major_reactant = None
+		for (subdev,subdev_config) in subdev_configs.items():
+			if subdev_config.get("Analysis Device Type") == "Flow" and subdev_config.get("Major Reactant") == "True":
+				self.major_reactant = subdev
+				break
+
+		self.bypass_ratio = None #reactant/internal standard area of the last bypass injection
+		self.results = [] #one dict per analyzed run
+		self.queue = None #created in run(), inside the event loop
+		self.executor = None if rxn_clock.is_virtual() else concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix="gc_live") #downloads and json parsing stay off the event loop
+
+		self.results_header = ["GC Run ID","GC Time Stamp","Type","Conversion (%)"] + ["{} Selectivity (%)".format(product) for product in self.products] + ["Carbon Balance (%)"]
+		self.peaks_writer = LogWriter.from_settings(os.path.join(rxn_dirname,"gc_peaks_{}.csv".format(rxn_name)),["GC Run ID","GC Time Stamp","Species","Area","RT"],settings_json["logger"],flush_rows=1)
+		self.results_writer = LogWriter.from_settings(os.path.join(rxn_dirname,"gc_results_{}.csv".format(rxn_name)),self.results_header,settings_json["logger"],flush_rows=1)
+
+	def submit(self,gc_log_values):
+		#called with each row written to the gc log
+		if self.queue is None:
+			self.queue = asyncio.Queue()
+		self.queue.put_nowait(dict(zip(self.gc_header,gc_log_values)))
+
+	async def run(self):
+		#background task. Analyzes the logged runs one at a time, in the order they were logged
+		if self.queue is None:
+			self.queue = asyncio.Queue()
+		while True:
+			row = await self.queue.get()
+			try:
+				gc_data = await self.fetch(row["GC Run ID"])
+				if gc_data is not None:
+					self.analyze_run(row,gc_data)
+			except Exception as e: #live analysis must never take the reaction down
+				print("Live GC analysis of run {} failed: {}".format(row["GC Run ID"],repr(e)))
+			finally:
+				self.queue.task_done()
+
+	async def fetch(self,run_id):
+		start = rxn_clock.now()
+		while True:
+			try:
+				if self.executor is None:
+					return postrun_analysis.fetch_one(run_id,self.ip,retries=0,timeout=self.http_timeout,cache=self.cache)
+				return await asyncio.get_running_loop().run_in_executor(self.executor,postrun_analysis.fetch_one,run_id,self.ip,0,0,self.http_timeout,self.cache)
+			except IOError as e:
+				if rxn_clock.now() - start > self.timeout:
+					print("Giving up on live analysis of GC run {}: {}".format(run_id,e))
+					return None
+			await asyncio.sleep(self.retry_interval)
+
+	def injection_type(self,row):
+		if self.major_reactant is None:
+			return "Reaction"
+		reactor_temp = 999999 #no reactor temperature -> treat all data like rxn data
+		for (subdev,t_correction) in self.temp_columns:
+			reactor_temp = row[subdev] + t_correction
+		return postrun_analysis.injection_type(row[self.major_reactant],reactor_temp)
+
+	def analyze_run(self,row,gc_data):
+		run_id = row["GC Run ID"]
+		areas = {}
+		for (label,area,rt) in postrun_analysis.extract_peaks(gc_data):
+			self.peaks_writer.writerow([run_id,row["GC Time Stamp"],label,area,rt])
+			areas[label] = area
+
+		injection_type = self.injection_type(row)
+		ratio = np.nan
+		if areas.get(self.internal_standard,0) > 0:
+			ratio = areas.get(self.reactant,0)/areas[self.internal_standard]
+		if injection_type == "Bypass" and not np.isnan(ratio):
+			self.bypass_ratio = ratio
+
+		conversion = np.nan
+		selectivities = {product : np.nan for product in self.products}
+		carbon_balance = np.nan
+		if injection_type == "Reaction":
+			if self.bypass_ratio is not None and self.bypass_ratio > 0:
+				conversion = 100*(1 - ratio/self.bypass_ratio)
+			product_carbons = {product : carbons*areas.get(product,0)/self.response_factors.get(product,1) for (product,carbons) in self.products.items()}
+			total_carbons = sum(product_carbons.values())
+			if total_carbons > 0:
+				selectivities = {product : 100*carbons/total_carbons for (product,carbons) in product_carbons.items()}
+			if self.bypass_ratio and areas.get(self.internal_standard,0) > 0: #reactant carbons fed, from the bypass reactant/internal standard ratio
+				reactant_rf = self.response_factors.get(self.reactant,1)
+				feed_carbons = self.reactant_carbons*self.bypass_ratio*areas[self.internal_standard]/reactant_rf
+				carbon_balance = 100*(self.reactant_carbons*areas.get(self.reactant,0)/reactant_rf + total_carbons)/feed_carbons
+
+		result = {"GC Run ID" : run_id,"GC Time Stamp" : row["GC Time Stamp"],"Type" : injection_type,"Conversion (%)" : conversion}
+		result.update({"{} Selectivity (%)".format(product) : selectivity for (product,selectivity) in selectivities.items()})
+		result["Carbon Balance (%)"] = carbon_balance
+		self.results.append(result)
+		self.results_writer.writerow([result[column] for column in self.results_header])
+		self.print_summary()
+
+	def print_summary(self):
+		print("=============== Live GC Results ===============")
+		rows = [[result[column] for column in self.results_header] for result in self.results[-self.summary_rows:]]
+		print(tabulate.tabulate(rows,headers=self.results_header,floatfmt=".2f"))
+		print("\n")
+
+	async def finish(self,timeout=None):
+		#waits for the runs still queued, up to timeout seconds
+		if self.queue is not None:
+			try:
+				await asyncio.wait_for(self.queue.join(),timeout)
+			except asyncio.TimeoutError:
+				print("Live GC analysis did not finish in time. Remaining runs will be picked up by the post-run analysis")
+
+	def close(self):
+		self.peaks_writer.close()
+		self.results_writer.close()
+		if self.executor is not None:
+			self.executor.shutdown(wait=False)
@@ -0,0 +1,168 @@
+import csv
+import os
+import time
+import json
+import atexit
+import datetime
+import numpy as np
+import pandas as pd
+
+BINARY_LOG_DTYPE = "<f8"
+
+class LogWriter():
+	#Keeps a csv log file open for the whole run instead of reopening it for every row. Rows are buffered and handed to the OS
+	#every flush_interval seconds or every flush_rows rows (whichever comes first), and fsync'd to disk every fsync_interval seconds.
+	#A crash of the program loses at most one flush window, a crash of the PC at most one fsync window.
+	def __init__(self,filename,header=None,flush_interval=10,flush_rows=50,fsync_interval=60):
+		self.filename = filename
+		self.flush_interval = float(flush_interval) #seconds
+		self.flush_rows = int(flush_rows)
+		self.fsync_interval = float(fsync_interval) #seconds
+		self.file = open(self.filename,'w')
+		self.csv_writer = csv.writer(self.file, delimiter=',', lineterminator='\n',quoting=csv.QUOTE_MINIMAL)
+		self.buffered_rows = []
+		self.last_flush_time = time.time()
+		self.last_fsync_time = time.time()
+		if header is not None:
+			self.buffered_rows.append(header)
+			self.flush(fsync=True)
+		atexit.register(self.close) #make sure buffered rows are written if the program exits without closing the log
+
+	@classmethod
+	def from_settings(cls,filename,header,settings,**overrides):
+		#builds a writer from the flush settings in a config section (ex. settings_json["logger"]). Missing keys use the defaults.
+		kwargs = {"flush_interval" : settings.get("flush_interval (s)",10),
+					"flush_rows" : settings.get("flush_rows",50),
+					"fsync_interval" : settings.get("fsync_interval (s)",60)}
+		kwargs.update(overrides)
+		return cls(filename,header,**kwargs)
+
+	def writerow(self,row):
+		if self.file is None:
+			raise ValueError("Trying to write to closed log {}".format(self.filename))
+		self.buffered_rows.append(row)
+		now = time.time()
+		if len(self.buffered_rows) >= self.flush_rows or (now-self.last_flush_time) >= self.flush_interval:
+			self.flush(fsync=(now-self.last_fsync_time) >= self.fsync_interval)
+
+	def flush(self,fsync=False):
+		if self.file is None:
+			return
+		self.csv_writer.writerows(self.buffered_rows)
+		self.buffered_rows = []
+		self.file.flush()
+		self.last_flush_time = time.time()
+		if fsync:
+			os.fsync(self.file.fileno())
+			self.last_fsync_time = self.last_flush_time
+
+	def close(self):
+		if self.file is None:
+			return
+		self.flush(fsync=True)
+		self.file.close()
+		self.file = None
+		atexit.unregister(self.close)
+
+
+class BinaryLogWriter():
+	#Columnar binary companion to a csv log. Rows are stored as little-endian float64 with an epoch-seconds "Time" column, appended
+	#to <base>.f64 in row groups. Column names live in <base>.json. Non-numeric values are stored as NaN.
+	#Use read_binary_log to memory-map the result instead of re-parsing csv text.
+	def __init__(self,base_filename,columns,row_group_size=100,flush_interval=10,fsync_interval=60,metadata=None):
+		self.data_filename = base_filename + ".f64"
+		self.schema_filename = base_filename + ".json"
+		self.columns = ["Time"] + list(columns)
+		self.row_group_size = int(row_group_size)
+		self.flush_interval = float(flush_interval) #seconds
+		self.fsync_interval = float(fsync_interval) #seconds
+		with open(self.schema_filename,'w') as f:
+			json.dump({"columns" : self.columns, "dtype" : BINARY_LOG_DTYPE, "metadata" : metadata or {}},f,indent=1)
+		self.file = open(self.data_filename,'wb')
+		self.buffered_rows = []
+		self.last_flush_time = time.time()
+		self.last_fsync_time = time.time()
+		atexit.register(self.close)
+
+	@classmethod
+	def from_settings(cls,base_filename,columns,settings,metadata=None):
+		return cls(base_filename,columns,
+					row_group_size=settings.get("binary_row_group",100),
+					flush_interval=settings.get("flush_interval (s)",10),
+					fsync_interval=settings.get("fsync_interval (s)",60),
+					metadata=metadata)
+
+	def writerow(self,timestamp,values):
+		if self.file is None:
+			raise ValueError("Trying to write to closed log {}".format(self.data_filename))
+		row = [timestamp]
+		for value in values:
+			try:
+				row.append(float(value))
+			except (TypeError,ValueError):
+				row.append(np.nan)
+		self.buffered_rows.append(row)
+		now = time.time()
+		if len(self.buffered_rows) >= self.row_group_size or (now-self.last_flush_time) >= self.flush_interval:
+			self.flush(fsync=(now-self.last_fsync_time) >= self.fsync_interval)
+
+	def write_block(self,timestamps,values):
+		#Appends many rows at once (ex. a block of high-rate samples). values is a (rows, columns) array without the Time column.
+		if self.file is None:
+			raise ValueError("Trying to write to closed log {}".format(self.data_filename))
+		if self.buffered_rows:
+			self.flush()
+		np.column_stack([np.asarray(timestamps,dtype=BINARY_LOG_DTYPE),np.asarray(values,dtype=BINARY_LOG_DTYPE)]).tofile(self.file)
+		now = time.time()
+		if (now-self.last_flush_time) >= self.flush_interval:
+			self.flush(fsync=(now-self.last_fsync_time) >= self.fsync_interval)
+
+	def flush(self,fsync=False):
+		if self.file is None:
+			return
+		if self.buffered_rows:
+			np.asarray(self.buffered_rows,dtype=BINARY_LOG_DTYPE).tofile(self.file)
+			self.buffered_rows = []
+		self.file.flush()
+		self.last_flush_time = time.time()
+		if fsync:
+			os.fsync(self.file.fileno())
+			self.last_fsync_time = self.last_flush_time
+
+	def close(self):
+		if self.file is None:
+			return
+		self.flush(fsync=True)
+		self.file.close()
+		self.file = None
+		atexit.unregister(self.close)
+
+
+def epoch_to_local(times):
+	#epoch seconds -> naive local datetimes, the same wall clock time that time.ctime() writes to the csv logs
+	times = np.asarray(times,dtype=float)
+	index = pd.to_datetime(times,unit='s')
+	if len(times) == 0:
+		return index
+	offsets = {time.localtime(times[0]).tm_gmtoff,time.localtime(times[-1]).tm_gmtoff}
+	if len(offsets) == 1: #one utc offset for the whole run
+		return index + pd.Timedelta(seconds=offsets.pop())
+	return pd.DatetimeIndex([datetime.datetime.fromtimestamp(t) for t in times]) #run crossed a daylight saving change
+
+
+def read_binary_log(base_filename,as_dataframe=True):
+	#Memory-maps a log written by BinaryLogWriter. A partially written trailing row (ex. after a crash) is ignored.
+	with open(base_filename + ".json",'r') as f:
+		schema = json.load(f)
+	num_cols = len(schema["columns"])
+	itemsize = np.dtype(schema["dtype"]).itemsize
+	num_rows = os.path.getsize(base_filename + ".f64") // (itemsize*num_cols)
+	if num_rows == 0:
+		data = np.empty((0,num_cols),dtype=schema["dtype"])
+	else:
+		data = np.memmap(base_filename + ".f64",dtype=schema["dtype"],mode='r',shape=(num_rows,num_cols))
+	if not as_dataframe:
+		return data, schema["columns"]
+	df = pd.DataFrame(data,columns=schema["columns"],copy=False)
+	df.index = epoch_to_local(df["Time"])
+	return df
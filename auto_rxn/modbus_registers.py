@@ -0,0 +1,96 @@
+import struct
+import time
+
+MAX_BLOCK_REGISTERS = 125 #Modbus limit for one read holding registers request
+FLOAT_REGISTERS = 2 #a 32 bit float spans two 16 bit registers
+READ_ADDRESS_KEYS = ["SP Read Address","PV Read Address"] #subdevice config keys holding float registers that get read
+
+def plan_blocks(addresses,max_gap=8,max_registers=MAX_BLOCK_REGISTERS):
+	#Groups float register addresses into as few contiguous block reads as possible. Neighbouring values are merged into one block
+	#when the gap between them is at most max_gap registers (the gap is read and thrown away) and the block stays within max_registers.
+	#Returns a list of (start address, register count).
+	blocks = []
+	for address in sorted(set(addresses)):
+		end = address + FLOAT_REGISTERS
+		if blocks and address - blocks[-1][1] <= max_gap and end - blocks[-1][0] <= max_registers:
+			blocks[-1][1] = max(blocks[-1][1],end)
+		else:
+			blocks.append([address,end])
+	return [(start,end-start) for (start,end) in blocks]
+
+def poll_until(read_fn,matches,deadline=1.0,first_delay=0.01,max_delay=0.2):
+	#Write-verify helper. Calls read_fn until matches(value) is True, sleeping with a doubling backoff in between, or until deadline
+	#seconds have passed. Returns (last value read, seconds until it matched or None if it never did).
+	start = time.perf_counter()
+	delay = first_delay
+	while True:
+		value = read_fn()
+		elapsed = time.perf_counter()-start
+		if matches(value):
+			return (value,elapsed)
+		if elapsed + delay > deadline:
+			return (value,None)
+		time.sleep(delay)
+		delay = min(2*delay,max_delay)
+
+def decode_float(registers):
+	#two registers, most significant first (same byte order as minimalmodbus read_float defaults)
+	return struct.unpack('>f',struct.pack('>HH',registers[0],registers[1]))[0]
+
+
+class RegisterCache():
+	#Reads every configured float register of an instrument with the fewest block reads and serves per-address values from the last
+	#read. A value older than max_age seconds (or invalidated by a write) is read on its own instead.
+	def __init__(self,dev,addresses,max_age=1.0,max_gap=8,max_registers=MAX_BLOCK_REGISTERS):
+		self.dev = dev
+		self.addresses = sorted(set(addresses))
+		self.blocks = plan_blocks(self.addresses,max_gap,max_registers)
+		self.max_age = float(max_age) #seconds
+		self.values = {} #address -> (value, read time)
+		self.num_transactions = 0
+
+	@classmethod
+	def from_subdevices(cls,dev,subdevices,config):
+		#collects the numeric read addresses of every subdevice ("None" means the subdevice isn't read over Modbus)
+		addresses = []
+		for subdev in subdevices.values():
+			for key in READ_ADDRESS_KEYS:
+				address = subdev.config.get(key)
+				if isinstance(address,int):
+					addresses.append(address)
+		return cls(dev,addresses,
+					max_age=config.get("Register Cache Age (s)",1.0),
+					max_gap=config.get("Register Block Gap",8),
+					max_registers=config.get("Max Block Registers",MAX_BLOCK_REGISTERS))
+
+	def refresh(self):
+		for (start,count) in self.blocks:
+			registers = self.dev.read_registers(start,count)
+			read_time = time.perf_counter()
+			self.num_transactions += 1
+			for address in self.addresses:
+				if start <= address < start+count:
+					self.values[address] = (decode_float(registers[address-start:address-start+FLOAT_REGISTERS]),read_time)
+
+	def get(self,address):
+		#cached value, or None if there is no fresh one
+		if address in self.values:
+			(value,read_time) = self.values[address]
+			if time.perf_counter()-read_time <= self.max_age:
+				return value
+		return None
+
+	def read_float(self,address,fresh=False):
+		#fresh=True always reads the device (ex. verifying a write)
+		value = None if fresh else self.get(address)
+		if value is None:
+			value = self.dev.read_float(address)
+			self.num_transactions += 1
+			self.store(address,value)
+		return value
+
+	def store(self,address,value):
+		self.values[address] = (value,time.perf_counter())
+
+	def invalidate(self,address):
+		self.values.pop(address,None)
@@ -6,41 +6,156 @@ import os
 import shutil
 import requests
 import csv
+import threading
+import concurrent.futures
 from openpyxl import load_workbook
 import datetime
+from log_writer import read_binary_log, epoch_to_local
+from run_data_cache import RunDataCache
 
-def get_run_data(run_id,ip):
+def get_run_data(run_id,ip,session=None,timeout=30,cache=None):
 	if ip is None: #mock!
-		with open("./auto_rxn/bp_json.json",'r') as f:
+		with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),"bp_json.json"),'r') as f:
 			bp_json = json.load(f)
 		return bp_json
 	else:
-		time.sleep(0.1)
-		return requests.get("http://"+ip+"/v1/runData/"+run_id).json()
-
+		if cache is not None: #run data never changes once the run is done, so a cached copy is always good
+			run_data = cache.get(run_id)
+			if run_data is not None:
+				return run_data
+		if session is None:
+			session = requests
+		response = session.get("http://"+ip+"/v1/runData/"+run_id,timeout=timeout)
+		response.raise_for_status()
+		run_data = response.json()
+		if cache is not None:
+			cache.put(run_id,run_data)
+		return run_data
+
+def get_run_data_cache(rxn_dirname,gc_config):
+	#Cache of downloaded runData. Kept in the reaction directory unless the GC config names a shared "Run Data Cache Directory".
+	#"Run Data Cache Size (MB)" caps its size. Returns None if "Run Data Cache" is "False".
+	if gc_config.get("Run Data Cache","True") in ["False","false","F"]:
+		return None
+	directory = gc_config.get("Run Data Cache Directory","None")
+	if directory == "None":
+		directory = os.path.join(rxn_dirname,"gc_run_data")
+	return RunDataCache(os.path.expanduser(directory),max_bytes=gc_config.get("Run Data Cache Size (MB)",2000)*1024**2)
+
+thread_sessions = threading.local() #one keep-alive session per fetch thread
+
+def get_thread_session():
+	if not hasattr(thread_sessions,"session"):
+		thread_sessions.session = requests.Session()
+	return thread_sessions.session
+
+def fetch_one(run_id,ip,retries=3,backoff=0.5,timeout=30,cache=None):
+	#get_run_data with retries. Waits backoff, 2*backoff, ... seconds between attempts
+	delay = backoff
+	for attempt in range(retries+1):
+		try:
+			return get_run_data(run_id,ip,session=get_thread_session(),timeout=timeout,cache=cache)
+		except (requests.RequestException,ValueError) as e:
+			if attempt == retries:
+				raise IOError("Could not fetch GC run {} after {} attempts: {}".format(run_id,retries+1,e))
+			print("Fetching GC run {} failed ({}). Retrying in {} s".format(run_id,e,delay))
+			time.sleep(delay)
+			delay *= 2
+
+def fetch_run_data(run_ids,ip,max_workers=8,retries=3,backoff=0.5,timeout=30,progress_every=10,cache=None):
+	#Downloads the runData of every run id with at most max_workers requests in flight. Results come back in the order of run_ids.
+	run_data = [None]*len(run_ids)
+	start = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix="gc_fetch") as executor:
+		futures = {executor.submit(fetch_one,run_id,ip,retries,backoff,timeout,cache) : i for (i,run_id) in enumerate(run_ids)}
+		for (num_done,future) in enumerate(concurrent.futures.as_completed(futures),1):
+			run_data[futures[future]] = future.result()
+			if num_done % progress_every == 0 or num_done == len(run_ids):
+				print("Fetched {} of {} GC runs ({:.1f} s)".format(num_done,len(run_ids),time.perf_counter()-start))
+	if cache is not None:
+		print("GC run data cache: {} hits, {} downloaded".format(cache.hits,cache.misses))
+	return run_data
+
+
+
+GC_DETECTORS = ["moduleA:tcd","moduleB:tcd","moduleC:tcd","moduleD:tcd"]
+
+def extract_peaks(gc_data,detectors=GC_DETECTORS):
+	#labelled peaks of one run as (label, area, retention time), in detector order. Unlabelled peaks are ignored
+	peaks = []
+	for detector in detectors:
+		for peak in gc_data["detectors"][detector]["analysis"]["peaks"]:
+			if "label" in peak.keys():
+				peaks.append((peak["label"],peak["area"],peak["top"]))
+	return peaks
+
+def injection_type(major_reactant_flow,reactor_temp_corrected):
+	if major_reactant_flow < 0.1:
+		return "Unanalyzed" #Unanalyzed -> No major reactant found
+	elif reactor_temp_corrected < 200:
+		return "Bypass" #Bypass -> T < 200C
+	else:
+		return "Reaction"
 
+def get_subdev_configs(settings_json,columns):
+	#config of every subdevice that has a column in a log
+	subdev_configs = {}
+	for dev in settings_json.values():
+		for subdev_name in dev["Subdevices"].keys():
+			if subdev_name in columns:
+				subdev_configs[subdev_name] = dev["Subdevices"][subdev_name]
+	return subdev_configs
+
+def load_live_peaks(rxn_dirname,rxn_name):
+	#Peaks live_analysis already extracted during the reaction: {run id : [(label, area, retention time)]}. Only runs with a row in
+	#gc_results_<rxn>.csv are used, it is written after all of the run's peaks, so a run cut off mid-write is fetched again.
+	peaks_file = os.path.join(rxn_dirname,"gc_peaks_{}.csv".format(rxn_name))
+	results_file = os.path.join(rxn_dirname,"gc_results_{}.csv".format(rxn_name))
+	if not (os.path.isfile(peaks_file) and os.path.isfile(results_file)):
+		return {}
+	finished_runs = set(pd.read_csv(results_file,dtype={"GC Run ID" : str})["GC Run ID"])
+	peaks_df = pd.read_csv(peaks_file,dtype={"GC Run ID" : str,"Species" : str},float_precision="round_trip")
+	live_peaks = {}
+	for (run_id,label,area,rt) in zip(peaks_df["GC Run ID"],peaks_df["Species"],peaks_df["Area"],peaks_df["RT"]):
+		if run_id in finished_runs:
+			live_peaks.setdefault(run_id,[]).append((label,area,rt))
+	return live_peaks
+
+def load_rxn_log(rxn_dirname,rxn_name):
+	#Loads the process log of a reaction. Uses the memory-mapped binary log (epoch float Time, float SP/PV columns) when the run
+	#wrote one, otherwise parses the csv log.
+	base_filename = os.path.join(rxn_dirname,"rxn_log_"+rxn_name)
+	if os.path.isfile(base_filename+".f64") and os.path.isfile(base_filename+".json"):
+		return read_binary_log(base_filename)
+	df = pd.read_csv(base_filename+".csv")
+	df.index = pd.to_datetime(df["Time"],format="%c")
+	return df
+
+def add_injection_pvs(df,rxn_log,subdevs):
+	#adds a "<subdev> PV" column for each subdevice: the value in the process log row at or just before each injection
+	log_rows = np.searchsorted(rxn_log.index.values,epoch_to_local(df["GC Time Stamp"]).values,side='right') - 1
+	for subdev in subdevs:
+		column = subdev + " PV"
+		if column in rxn_log.columns:
+			values = pd.to_numeric(rxn_log[column],errors='coerce').to_numpy(dtype=float)
+			df[column] = np.where(log_rows >= 0,values[np.maximum(log_rows,0)],np.nan)
 
 def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 	#takes in the directory for a reaction and produces an analysis
 
-	rxn_name = rxn_dirname.split('\\')[-1]
+	rxn_name = os.path.basename(os.path.normpath(rxn_dirname))
 	gc_logfile_string = "gc_log_"+rxn_name
 	config_file_string = "rxn_control_config.json"
 
 	#load each gc data point
 	gc_log_csv = os.path.join(rxn_dirname,gc_logfile_string)
 	gc_log_csv += '.csv'
-	gc_log_csv.replace("\\","/")
 	df = pd.read_csv(gc_log_csv)
 
 	#get the config of each subdevice used
-	subdev_configs = {}
-	with open(rxn_dirname+"\\"+config_file_string, 'r') as f:
+	with open(os.path.join(rxn_dirname,config_file_string), 'r') as f:
 		settings_json = json.load(f)
-		for dev in settings_json.values():
-			for subdev_name in dev["Subdevices"].keys():
-				if subdev_name in df.columns:
-					subdev_configs[subdev_name] = dev["Subdevices"][subdev_name]
+	subdev_configs = get_subdev_configs(settings_json,df.columns)
 
 	gc_name = settings_json["main"]["GC Module Name"]
 	ip = settings_json[gc_name]["IP Address"]
@@ -86,15 +201,17 @@ def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 	type_arr = []
 	df = df.reset_index()
 	for i, row in df.iterrows():
-	    if df[major_reactant][i] < 0.1: 
-	    	type_arr.append("Unanalyzed") #Unanalyzed -> No major reactant found
-	    else:
-	    	if df["Reactor Temperature Corrected"][i] < 200:
-	    		type_arr.append("Bypass") #Bypass -> T < 200C
-	    	else:
-	    		type_arr.append("Reaction")
+		type_arr.append(injection_type(df[major_reactant][i],df["Reactor Temperature Corrected"][i]))
 	df["Type"] = type_arr
 
+	#Add the measured flows and temperatures at each injection from the process log
+	try:
+		rxn_log = load_rxn_log(rxn_dirname,rxn_name)
+	except FileNotFoundError:
+		print("No process log found. Skipping measured PVs.")
+	else:
+		add_injection_pvs(df,rxn_log,[subdev for (subdev,subdev_config) in subdev_configs.items() if subdev_config.get("Analysis Device Type") in ["Flow","Reactor Temp"]])
+
 
 
 
@@ -106,35 +223,33 @@ def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 	gc_rts = {}
 	df = df.reset_index()
 
+	gc_config = settings_json[gc_name]
+	run_peaks = load_live_peaks(rxn_dirname,rxn_name) #runs parsed during the reaction don't need to be fetched or parsed again
+	run_ids = [str(run_id) for run_id in df["GC Run ID"]]
+	missing_run_ids = list(dict.fromkeys(run_id for run_id in run_ids if run_id not in run_peaks))
+	print("{} of {} GC runs were parsed during the reaction".format(len(run_ids)-len(missing_run_ids),len(run_ids)))
+	if missing_run_ids:
+		fetched_gc_data = fetch_run_data(missing_run_ids,ip,
+										max_workers=gc_config.get("Fetch Workers",8),
+										retries=gc_config.get("HTTP Retries",3),
+										backoff=gc_config.get("HTTP Backoff (s)",0.5),
+										timeout=gc_config.get("HTTP Timeout (s)",30),
+										cache=get_run_data_cache(rxn_dirname,gc_config))
+		for (run_id,gc_data) in zip(missing_run_ids,fetched_gc_data):
+			run_peaks[run_id] = extract_peaks(gc_data)
 	for i, row in df.iterrows():
-		run_id = row["GC Run ID"]
+		run_id = run_ids[i]
 		print("Loading gc row {} with id {}".format(i,run_id))
 
 		# if df["Type"][i] != "Unanalyzed":
 
-		gc_data = get_run_data(run_id,ip)
-		#time.sleep(2)
-		gc_detector_data = gc_data["detectors"]
-		for detector in ["moduleA:tcd","moduleB:tcd","moduleC:tcd","moduleD:tcd"]:
-			peaks = gc_detector_data[detector]["analysis"]["peaks"]
-			if detector=="moduleD:tcd":
-				if "water" not in [peak["label"] if "label" in peak.keys() else None for peak in peaks] and "h2o2?" not in [peak["label"] if "label" in peak.keys() else None for peak in peaks]:
-					pass
-					# import iso8601
-					# from dateutil import tz
-					# print("water not found for this row! Timestamp: {}".format(iso8601.parse_date(gc_data["runTimeStamp"]).astimezone(tz.tzlocal())))
-					# print("Only peaks found are: {}".format( [peak["label"] if "label" in peak.keys() else '' for peak in peaks]))
-					# raise NotImplementedError()
-			for peak in peaks:
-				if "label" not in peak.keys():
-					pass #unlabelled peaks are ignored
-				else:
-					if peak["label"] not in gc_areas.keys(): #if it's the first time we've run across this species
-						gc_areas[peak["label"]] = [peak["area"]]
-						gc_rts[peak["label"]] = [peak["top"]]
-					else: #otherwise just append
-						gc_areas[peak["label"]].append(peak["area"])
-						gc_rts[peak["label"]].append(peak["top"])
+		for (label,area,rt) in run_peaks[run_id]:
+			if label not in gc_areas.keys(): #if it's the first time we've run across this species
+				gc_areas[label] = [area]
+				gc_rts[label] = [rt]
+			else: #otherwise just append
+				gc_areas[label].append(area)
+				gc_rts[label].append(rt)
 
 	df_for_data_dump = df.copy()
 
@@ -161,7 +276,7 @@ def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 	else:
 		df_for_data_dump.sort_values(by=["GC Time Stamp"])
 
-	df_for_data_dump.to_excel(rxn_dirname+"\\"+rxn_name+" gc data unanalyzed.xlsx")
+	df_for_data_dump.to_excel(os.path.join(rxn_dirname,rxn_name+" gc data unanalyzed.xlsx"))
 	print("Unanalyzed data dumped successfully.")
 
 
@@ -181,7 +296,7 @@ def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 
 
 
-		wb = load_workbook(settings_dirname+"\\AnalysisTemplateHeterogeneous6Flow.xlsx")
+		wb = load_workbook(os.path.join(settings_dirname,"AnalysisTemplateHeterogeneous6Flow.xlsx"))
 		
 		col_names=["Timestamp (Formatted)", "Reaction Name","oxygen","nitrogen","methane","carbon monoxide","carbon dioxide",
 		"ethane","ethylene","propane","propylene","isobutane","n-butane","trans-2-butene","1-butene","isobutene","cis-2-butene",
@@ -221,7 +336,7 @@ def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 			print("Analyzed reactor {}".format(r))	
 
 		#Creating filepath
-		filestr = rxn_dirname + "\\" + rxn_name+ "_Analysis6Flow" + ".xlsx"
+		filestr = os.path.join(rxn_dirname,rxn_name+ "_Analysis6Flow" + ".xlsx")
 		wb.save(filestr)	
 		print("Analysis completed successfully. Access at {}".format(filestr))
 		return True
@@ -319,7 +434,7 @@ def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 		for (idx,dataset) in sorted_rows.items():
 
 			#Creating copy of analysis file
-			filestr = rxn_dirname + "\\" + rxn_name+ "_Analysis" 
+			filestr = os.path.join(rxn_dirname,rxn_name+ "_Analysis")
 			for species, pct in zip(flow_subdevs,flow_pcts[idx]):
 				pct = round(pct)
 				filestr += "_"
@@ -328,7 +443,7 @@ def analyze(rxn_dirname,settings_dirname,just_dump=False,six_flow=False):
 				filestr += str(pct) 
 			filestr += ".xlsx"
 			print(filestr)
-			shutil.copy2(settings_dirname+"\\AnalysisTemplate.xlsx",filestr)	
+			shutil.copy2(os.path.join(settings_dirname,"AnalysisTemplate.xlsx"),filestr)	
 
 			#Constructing new dataframe to add to template
 			df = pd.DataFrame(columns = df_bypass.columns)
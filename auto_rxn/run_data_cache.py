@@ -0,0 +1,96 @@
+import os
+import re
+import gzip
+import json
+import uuid
+import threading
+
+class RunDataCache():
+	#On-disk cache of GC runData, one gzip'd json file per run id. Run data never changes once a run is finished, so entries are
+	#never refreshed, only evicted: when the cache grows past max_bytes the least recently used files are deleted.
+	#Safe to share between threads and (since writes are atomic renames) between processes analyzing at the same time.
+	def __init__(self,directory,max_bytes=2*1024**3,compress_level=6):
+		self.directory = directory
+		self.max_bytes = int(max_bytes)
+		self.compress_level = int(compress_level)
+		os.makedirs(self.directory,exist_ok=True)
+		self.lock = threading.Lock()
+		self.size = sum(size for (path,size,mtime) in self.list_entries()) #bytes on disk
+		self.hits = 0
+		self.missed_run_ids = set() #retries of the same run count as one miss
+
+	@property
+	def misses(self):
+		#run ids that weren't in the cache
+		return len(self.missed_run_ids)
+
+	def path(self,run_id):
+		return os.path.join(self.directory,re.sub(r'[^A-Za-z0-9_.-]','_',str(run_id)) + ".json.gz")
+
+	def get(self,run_id):
+		#cached run data, or None
+		path = self.path(run_id)
+		try:
+			with gzip.open(path,'rt',encoding='utf-8') as f:
+				run_data = json.load(f)
+		except FileNotFoundError:
+			with self.lock:
+				self.missed_run_ids.add(run_id)
+			return None
+		except (OSError,EOFError,ValueError): #partially written or corrupted entry. Drop it and fetch again
+			print("Discarding unreadable GC cache entry {}".format(path))
+			self.remove(path)
+			with self.lock:
+				self.missed_run_ids.add(run_id)
+			return None
+		try:
+			os.utime(path) #mark as recently used
+		except OSError:
+			pass
+		with self.lock:
+			self.hits += 1
+		return run_data
+
+	def put(self,run_id,run_data):
+		path = self.path(run_id)
+		temp_path = "{}.{}.tmp".format(path,uuid.uuid4().hex)
+		with gzip.open(temp_path,'wt',encoding='utf-8',compresslevel=self.compress_level) as f:
+			json.dump(run_data,f)
+		size = os.path.getsize(temp_path)
+		with self.lock:
+			try:
+				size -= os.path.getsize(path) #rewriting an entry replaces its old file
+			except FileNotFoundError:
+				pass
+			os.replace(temp_path,path)
+			self.size += size
+			if self.size > self.max_bytes:
+				self.evict()
+
+	def list_entries(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith(".json.gz"):
+				path = os.path.join(self.directory,name)
+				try:
+					stat = os.stat(path)
+				except FileNotFoundError: #evicted by someone else in the meantime
+					continue
+				entries.append((path,stat.st_size,stat.st_mtime))
+		return entries
+
+	def evict(self):
+		#deletes least recently used entries until the cache is at 90% of max_bytes. Called with the lock held
+		entries = sorted(self.list_entries(),key=lambda entry : entry[2])
+		self.size = sum(size for (path,size,mtime) in entries)
+		for (path,size,mtime) in entries:
+			if self.size <= 0.9*self.max_bytes:
+				break
+			self.remove(path)
+			self.size -= size
+
+	def remove(self,path):
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
@@ -0,0 +1,89 @@
+import asyncio
+import selectors
+import time
+
+class WallClock():
+	#Default clock. Real time, real sleeps.
+	def now(self):
+		return time.time()
+
+	def run(self,coro):
+		return asyncio.run(coro)
+
+
+class VirtualClock():
+	#Time-warp clock for mock reactions. Virtual time only moves when every task is waiting on a timer (asyncio.sleep, wait_for, ...),
+	#and then it jumps straight to the next timer instead of sleeping. A recipe of several hours runs in seconds against mock devices
+	#while the logs still get the timestamps the real run would have had.
+	def __init__(self,start_time=None):
+		if start_time is None:
+			start_time = time.time()
+		self.start_time = float(start_time)
+		self.elapsed = 0.0 #the event loop runs on elapsed seconds. Epoch-sized floats are too coarse for asyncio's timer resolution
+
+	def now(self):
+		return self.start_time + self.elapsed
+
+	def advance(self,seconds):
+		self.elapsed += seconds
+
+	def run(self,coro):
+		loop = TimeWarpEventLoop(self)
+		try:
+			asyncio.set_event_loop(loop)
+			return loop.run_until_complete(coro)
+		finally:
+			try:
+				loop.run_until_complete(loop.shutdown_asyncgens())
+			finally:
+				asyncio.set_event_loop(None)
+				loop.close()
+
+
+class TimeWarpSelector(selectors.DefaultSelector):
+	#The event loop calls select(timeout) with the time until its next timer. If nothing is ready, skip the wait and advance the clock.
+	def __init__(self,clock):
+		super().__init__()
+		self.clock = clock
+
+	def select(self,timeout=None):
+		ready = super().select(0)
+		if ready or timeout is None or timeout <= 0:
+			if not ready and timeout is None: #no timers pending, wait for real i/o (ex. a worker thread finishing)
+				return super().select(None)
+			return ready
+		self.clock.advance(timeout)
+		return []
+
+
+class TimeWarpEventLoop(asyncio.SelectorEventLoop):
+	def __init__(self,clock):
+		super().__init__(selector=TimeWarpSelector(clock))
+		self.clock = clock
+
+	def time(self):
+		return self.clock.elapsed
+
+
+clock = WallClock()
+
+def set_clock(new_clock):
+	global clock
+	clock = new_clock
+
+def get_clock():
+	return clock
+
+def is_virtual():
+	return isinstance(clock,VirtualClock)
+
+def now():
+	return clock.now()
+
+def ctime(seconds=None):
+	if seconds is None:
+		seconds = now()
+	return time.ctime(seconds)
+
+def run(coro):
+	return clock.run(coro)
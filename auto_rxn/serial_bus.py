@@ -0,0 +1,105 @@
+import serial
+import threading
+import time
+
+class SerialBus():
+	#One shared connection per physical port. Every driver on the port talks through request()/request_many(), which hold the
+	#bus lock for the whole write + read, so replies from devices sharing an RS-485 bus can't get interleaved.
+	#Commands are written without any fixed sleeps and each reply is read up to its terminator, with the port timeout as deadline.
+	def __init__(self,port,baudrate,timeout=None):
+		self.port = port
+		self.baudrate = baudrate
+		self.ser = serial.serial_for_url(port,baudrate=baudrate,timeout=timeout) #plain port names or pyserial urls (ex. socket://host:port)
+		self.lock = threading.RLock()
+
+		#utilization stats
+		self.open_time = time.perf_counter()
+		self.busy_time = 0.0 #seconds spent inside a request
+		self.num_requests = 0
+		self.num_timeouts = 0
+		self.bytes_written = 0
+		self.bytes_read = 0
+
+	def request(self,command,terminator=b'\n'):
+		#writes one command (str or bytes) and returns its decoded reply ('' or a partial reply on timeout)
+		return self.request_many([command],terminator)[0]
+
+	def request_timed(self,command,reply_wait=0.1):
+		#For devices whose replies have no terminator: writes one command, waits reply_wait seconds and returns whatever has arrived
+		with self.lock:
+			start = time.perf_counter()
+			try:
+				self.ser.reset_input_buffer()
+				data = command if isinstance(command,bytes) else command.encode('ascii')
+				self.ser.write(data)
+				self.bytes_written += len(data)
+				time.sleep(reply_wait)
+				reply = self.ser.read(self.ser.in_waiting)
+				self.bytes_read += len(reply)
+				self.num_requests += 1
+				return reply.decode('ascii',errors='replace')
+			finally:
+				self.busy_time += time.perf_counter()-start
+
+	def request_many(self,commands,terminator=b'\n'):
+		#Pipelines several commands: all are written back to back, then one reply per command is read in order.
+		#Once a reply times out the rest are returned as '' instead of waiting out the deadline again.
+		with self.lock:
+			start = time.perf_counter()
+			try:
+				self.ser.reset_input_buffer() #drop the tail of any earlier reply that came in after its deadline
+				data = b"".join([command if isinstance(command,bytes) else command.encode('ascii') for command in commands])
+				self.ser.write(data)
+				self.bytes_written += len(data)
+				replies = []
+				timed_out = False
+				for command in commands:
+					if timed_out:
+						replies.append('')
+						continue
+					reply = self.ser.read_until(terminator)
+					self.bytes_read += len(reply)
+					if not reply.endswith(terminator):
+						self.num_timeouts += 1
+						timed_out = True
+					replies.append(reply.decode('ascii',errors='replace'))
+				self.num_requests += len(commands)
+				return replies
+			finally:
+				self.busy_time += time.perf_counter()-start
+
+	def get_stats(self):
+		elapsed = time.perf_counter()-self.open_time
+		return {"Port" : self.port,
+				"Requests" : self.num_requests,
+				"Timeouts" : self.num_timeouts,
+				"Busy (s)" : self.busy_time,
+				"Utilization (%)" : 100*self.busy_time/elapsed if elapsed > 0 else 0,
+				"Line Utilization (%)" : 100*10*(self.bytes_written+self.bytes_read)/(self.baudrate*elapsed) if elapsed > 0 else 0} #10 bits per byte on the wire
+
+	def close(self):
+		with self.lock:
+			self.ser.close()
+
+
+buses = {} #port -> SerialBus
+buses_lock = threading.Lock()
+
+def get_bus(port,baudrate,timeout=None):
+	#returns the process-wide bus for a port, opening it on first use
+	with buses_lock:
+		if port not in buses:
+			buses[port] = SerialBus(port,baudrate,timeout)
+		elif buses[port].baudrate != baudrate:
+			raise ValueError("Port {} is already open at {} baud. Cannot share it at {} baud.".format(port,buses[port].baudrate,baudrate))
+		return buses[port]
+
+def get_utilization():
+	with buses_lock:
+		return [bus.get_stats() for bus in buses.values()]
+
+def close_all():
+	with buses_lock:
+		for bus in buses.values():
+			bus.close()
+		buses.clear()
@@ -0,0 +1,107 @@
+import bisect
+import math
+
+class StreamFilter():
+	#Per-reading filter for noisy temperature inputs. Keeps the last window accepted readings in a fixed ring buffer (running sum
+	#for the mean, a sorted copy for the median) so each update costs the same however long the run is: O(1) for the mean and
+	#O(window) for the median (bisect + list insert). Windows are a handful of readings, where a sorted list beats a heap based
+	#O(log window) median.
+	#A reading is rejected when it isn't a number, is outside [min_value, max_value], or jumps more than max_jump from the current
+	#filtered value. A rejected reading returns the filtered value of the readings before it. After max_rejections rejected readings
+	#in a row the raw reading is passed through instead: a real step change (jump) becomes the new baseline, and a dead sensor
+	#(out of range) still reaches the emergency checks.
+	#Readings equal to one of pass_through (sentinels such as the -9999 sensor break value) are returned as is right away and
+	#never enter the buffer, so sensor break detection isn't delayed.
+	def __init__(self,name,window=1,mode="median",min_value=None,max_value=None,max_jump=None,max_rejections=1,pass_through=()):
+		if mode not in ["median","mean"]:
+			raise ValueError("Filter mode must be median or mean, got {}".format(mode))
+		self.name = name
+		self.window = max(1,int(window))
+		self.mode = mode
+		self.min_value = min_value
+		self.max_value = max_value
+		self.max_jump = max_jump
+		self.max_rejections = int(max_rejections)
+		self.pass_through = [float(value) for value in pass_through]
+
+		self.ring = [0.0]*self.window
+		self.index = 0 #next slot to overwrite
+		self.count = 0 #accepted readings in the ring
+		self.total = 0.0
+		self.ordered = [] #same readings, sorted
+
+		self.consecutive_rejections = 0
+		self.num_rejected = 0
+
+	@classmethod
+	def from_config(cls,name,config,section="Filter",**defaults):
+		#builds a filter from a section (default "Filter") of a subdevice or device config. Missing keys use the defaults given here,
+		#then the class defaults.
+		settings = dict(defaults)
+		key_map = {"Window" : "window", "Mode" : "mode", "Min" : "min_value", "Max" : "max_value", "Max Jump" : "max_jump", "Max Rejections" : "max_rejections", "Pass Through" : "pass_through"}
+		for (key,value) in config.get(section,{}).items():
+			if key not in key_map:
+				raise ValueError("Unknown filter setting {} for {}".format(key,name))
+			settings[key_map[key]] = None if value == "None" else value
+		return cls(name,**settings)
+
+	def check(self,value):
+		#reason for rejecting a reading, or None if it is fine
+		if value is None or not isinstance(value,(int,float)) or math.isnan(value):
+			return "not a number"
+		if (self.min_value is not None and value < self.min_value) or (self.max_value is not None and value > self.max_value):
+			return "out of range"
+		if self.max_jump is not None and self.count > 0 and abs(value - self.value()) > self.max_jump:
+			return "jump"
+		return None
+
+	def update(self,value):
+		if isinstance(value,(int,float)) and value in self.pass_through:
+			return value
+		reason = self.check(value)
+		if reason is None:
+			self.consecutive_rejections = 0
+			self.push(value)
+			return self.value()
+
+		self.num_rejected += 1
+		self.consecutive_rejections += 1
+		if self.count == 0 or self.consecutive_rejections > self.max_rejections:
+			print("{}: passing through reading {} after {} rejected in a row ({})".format(self.name,value,self.consecutive_rejections,reason))
+			if reason == "jump":
+				self.reset()
+				self.push(value)
+			return value
+		print("{}: rejected reading {} ({}). Using {}".format(self.name,value,reason,self.value()))
+		return self.value()
+
+	def push(self,value):
+		if self.count == self.window: #drop the oldest reading
+			old = self.ring[self.index]
+			self.total -= old
+			del self.ordered[bisect.bisect_left(self.ordered,old)]
+		else:
+			self.count += 1
+		self.ring[self.index] = value
+		self.index = (self.index + 1) % self.window
+		self.total += value
+		if self.index == 0:
+			self.total = sum(self.ring) #once per lap, so rounding errors in the running sum can't build up
+		bisect.insort(self.ordered,value)
+
+	def value(self):
+		if self.count == 0:
+			return None
+		if self.mode == "mean":
+			return self.total/self.count
+		middle = self.count//2
+		if self.count % 2:
+			return self.ordered[middle]
+		return (self.ordered[middle-1] + self.ordered[middle])/2
+
+	def reset(self):
+		self.index = 0
+		self.count = 0
+		self.total = 0.0
+		self.ordered = []
+		self.consecutive_rejections = 0
@@ -1,4 +1,4 @@
-import serial
+import serial_bus
 import time
 
 class Device():
@@ -14,11 +14,8 @@ class Device():
 			for subdev_name in params.keys(): #for each subdevice in input file
 				self.subdevices[subdev_name] = Mock_Subdevice(subdev_name,params[subdev_name],config["Subdevices"][subdev_name])
 		else:
-			#generating the serial connection that each controller will use
-			self.ser = serial.Serial(baudrate=config["baudrate"], timeout=config["timeout"])
-			self.ser.port = config["port"]
-			self.ser.close()
-			self.ser.open()
+			#shared serial bus that each controller on this port will use
+			self.ser = serial_bus.get_bus(config["port"],config["baudrate"],config["timeout"])
 
 			#initializing each controller with its specific max flow, name, etc.
 			for subdev_name in config["Subdevices"].keys():
@@ -124,12 +121,7 @@ class Subdevice():
 
 	def comm(self, ser, command):
 		""" Send commands to device and recieve reply """
-		ser.write(command.encode())
-		time.sleep(0.5)
-
-		return_string = ser.readline()
-		return_string = return_string.decode()
-		return return_string
+		return ser.request(command) #reads up to the end of the reply line instead of sleeping a fixed time
 		
 	def get_max_setting(self):
 		return self.max_setting
\ No newline at end of file
@@ -0,0 +1,262 @@
+"""Benchmarks for the reaction control loop, logging and post-run analysis."""
+import os
+import sys
+import json
+import time
+import copy
+import click
+import asyncio
+import shutil
+import tempfile
+import platform
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.path.join(REPO_DIR,"auto_rxn")) #modules import each other flat, same as when running cli.py
+
+import auto_rxn
+import postrun_analysis
+from log_writer import LogWriter
+
+GC_SUBDEVICES = {"Number of Samples" : {"Max Setting" : "None","Analysis Device Type" : "None","Dynamicity":"Static"},
+				"Delay Time" : {"Max Setting" : "None","Analysis Device Type" : "None","Dynamicity":"Static"}}
+
+
+def make_settings(num_mfcs):
+	#mock settings with num_mfcs flow controllers on one bronkhorst bus, a furnace and the gc
+	mfcs = {}
+	for i in range(num_mfcs):
+		mfcs["MFC {}".format(i)] = {"node" : i+3,"Max Setting" : 100,"Flow Dev Lim" : 2,"Analysis Device Type" : "Flow","Correction Factor" : 1,
+									"Major Reactant" : "True" if i == 0 else "False","Dynamicity" : "Static"}
+	return {"main" : {"GC Module Name" : "inficon_gc","Subdevices" : {},"mock" : "True"},
+			"logger" : {"log_interval (s)" : 5,"binary_log" : "False","Subdevices" : {}},
+			"inficon_gc" : {"IP Address" : None,"Default Method" : "bench","Subdevices" : copy.deepcopy(GC_SUBDEVICES),"async" : 0},
+			"bronkhorst_mfc" : {"port" : "bench_bus","baudrate" : 38400,"timeout" : 1,"Flow Wait Time (sec)" : 10,"Subdevices" : mfcs,"async" : 0},
+			"eurotherm_3216" : {"port" : "bench_furnace","address" : 1,"baudrate" : 9600,"timeout" : 1,"async" : 0,"Subdevices" : {
+				"Furnace Temp" : {"SP Write Address" : 2,"SP Read Address" : 2,"PV Read Address" : 1,"Max Setting" : 950,"Change Wait Time" : 15,"Dev Lim" : 800,
+									"Dev Type" : "Do not check for emergency","Analysis Device Type" : "Reactor Temp","T Correction" : 0,"Dynamicity" : "Static"}}}}
+
+
+def make_recipe(settings_json,num_steps):
+	#recipe dataframe in the csv layout: units, emergency, parent device, start marker, then one row per step
+	columns = ["Control Point Name"]
+	parents = [None]
+	for device_name in ["bronkhorst_mfc","eurotherm_3216","inficon_gc"]:
+		for subdev_name in settings_json[device_name]["Subdevices"].keys():
+			columns.append(subdev_name)
+			parents.append(device_name)
+	rows = [["Control Point Units"] + ["None"]*(len(columns)-1),
+			["Control Point Emergency Value"] + ["0"]*(len(columns)-1),
+			["Control Point Parent Device Name"] + parents[1:],
+			["RECPE_STARTS_BELOW"] + [None]*(len(columns)-1)]
+	for step in range(num_steps):
+		row = ["1"]
+		for subdev_name in columns[1:]:
+			if subdev_name == "Furnace Temp":
+				row.append(str(100 + step % 400))
+			elif subdev_name in GC_SUBDEVICES:
+				row.append("0")
+			else:
+				row.append(str((step*7 + len(row)) % 50))
+		rows.append(row)
+	return pd.DataFrame(rows,columns=columns,dtype=object)
+
+
+def summarize(samples):
+	samples = np.asarray(samples)*1000 #ms
+	return {"n" : int(samples.size),
+			"mean_ms" : float(samples.mean()),
+			"median_ms" : float(np.median(samples)),
+			"p95_ms" : float(np.percentile(samples,95)),
+			"min_ms" : float(samples.min())}
+
+
+def build_reaction(num_mfcs,num_steps,workdir):
+	settings_json = make_settings(num_mfcs)
+	inputs_df = make_recipe(settings_json,num_steps)
+	rxn_dirname = tempfile.mkdtemp(dir=workdir)
+	with contextlib.redirect_stdout(open(os.devnull,'w')):
+		rxn = auto_rxn.Reaction(inputs_df,settings_json,"bench",rxn_dirname,True)
+	return rxn
+
+
+def bench_tick(device_counts,iterations,workdir):
+	#one loop tick = read every SP/PV through the dispatcher and run the emergency check
+	results = {}
+	for num_mfcs in device_counts:
+		rxn = build_reaction(num_mfcs,2,workdir)
+		async def run():
+			await rxn.set_setpts()
+			samples = []
+			for i in range(iterations):
+				start = time.perf_counter()
+				await rxn.take_snapshot()
+				rxn.is_emergency()
+				samples.append(time.perf_counter()-start)
+			return samples
+		results["{} subdevices".format(rxn.num_subdevs)] = summarize(asyncio.run(run()))
+		rxn.close_logs()
+		rxn.dispatcher.shutdown()
+	return results
+
+
+def bench_log(num_mfcs,rows,workdir):
+	#Reaction.log end to end (snapshot, csv row, console table) and the csv writer on its own
+	rxn = build_reaction(num_mfcs,2,workdir)
+	async def run():
+		await rxn.set_setpts()
+		samples = []
+		with contextlib.redirect_stdout(open(os.devnull,'w')):
+			for i in range(rows):
+				start = time.perf_counter()
+				await rxn.log(headers=False)
+				samples.append(time.perf_counter()-start)
+		return samples
+	samples = asyncio.run(run())
+	rxn.close_logs()
+	rxn.dispatcher.shutdown()
+	results = {"Reaction.log" : summarize(samples)}
+	results["Reaction.log"]["rows_per_s"] = float(len(samples)/np.sum(samples))
+
+	writer = LogWriter(os.path.join(workdir,"writer_bench.csv"),rxn.log_header)
+	row = [time.ctime(),"bench"] + list(range(len(rxn.log_header)-2))
+	start = time.perf_counter()
+	for i in range(rows*10):
+		writer.writerow(row)
+	writer.close()
+	results["LogWriter.writerow"] = {"n" : rows*10,"rows_per_s" : float(rows*10/(time.perf_counter()-start))}
+	return results
+
+
+def bench_set_setpts(num_mfcs,num_steps,workdir):
+	#full step switch: every subdevice gets its next setpoint
+	rxn = build_reaction(num_mfcs,num_steps,workdir)
+	async def run():
+		samples = []
+		with contextlib.redirect_stdout(open(os.devnull,'w')):
+			for i in range(num_steps):
+				start = time.perf_counter()
+				await rxn.set_setpts()
+				samples.append(time.perf_counter()-start)
+		return samples
+	results = {"{} subdevices".format(rxn.num_subdevs) : summarize(asyncio.run(run()))}
+	rxn.close_logs()
+	rxn.dispatcher.shutdown()
+	return results
+
+
+def make_analysis_dir(num_injections,workdir):
+	#synthetic reaction directory: gc_log + settings copy. Alternates bypass (cold) and reaction (hot) injections.
+	settings_json = make_settings(2)
+	rxn_dirname = os.path.join(workdir,"analysis_{}".format(num_injections))
+	os.mkdir(rxn_dirname)
+	with open(os.path.join(rxn_dirname,"rxn_control_config.json"),'w') as f:
+		json.dump(settings_json,f)
+	rng = np.random.default_rng(0)
+	gc_log = pd.DataFrame({"Reaction Name" : "analysis_{}".format(num_injections),
+							"inficon_gc" : "inficon_gc",
+							"GC Run ID" : ["bench-{}".format(i) for i in range(num_injections)],
+							"GC Time Stamp" : 1.7e9 + 600*np.arange(num_injections),
+							"MFC 0" : 5.0,
+							"MFC 1" : rng.choice([20.0,40.0],num_injections),
+							"Furnace Temp" : np.where(np.arange(num_injections) % 2 == 0,25.0,450.0),
+							"Number of Samples" : 1,
+							"Delay Time" : 0})
+	gc_log.to_csv(os.path.join(rxn_dirname,"gc_log_analysis_{}.csv".format(num_injections)),index=False)
+
+	#runData for every injection. A handful of perturbed copies of the stored example run is enough to exercise the peak parsing.
+	with open(os.path.join(REPO_DIR,"auto_rxn","bp_json.json"),'r') as f:
+		example_run = json.load(f)
+	variants = []
+	for i in range(8):
+		run = copy.deepcopy(example_run)
+		for detector in run["detectors"].values():
+			for peak in detector["analysis"]["peaks"]:
+				peak["area"] = peak["area"]*(1+0.01*i)
+		variants.append(run)
+	run_data = {run_id : variants[i % len(variants)] for (i,run_id) in enumerate(gc_log["GC Run ID"])}
+	return rxn_dirname,run_data
+
+
+def bench_analysis(sizes,workdir):
+	#postrun_analysis.analyze(just_dump=True) with runData served from memory, so only the analysis itself is timed
+	results = {}
+	get_run_data = postrun_analysis.get_run_data
+	try:
+		for num_injections in sizes:
+			rxn_dirname,run_data = make_analysis_dir(num_injections,workdir)
+			postrun_analysis.get_run_data = lambda run_id,ip,**kwargs : run_data[run_id]
+			start = time.perf_counter()
+			with contextlib.redirect_stdout(open(os.devnull,'w')):
+				postrun_analysis.analyze(rxn_dirname,os.path.join(REPO_DIR,"config_files"),just_dump=True)
+			elapsed = time.perf_counter()-start
+			results["{} injections".format(num_injections)] = {"seconds" : elapsed,"injections_per_s" : num_injections/elapsed}
+	finally:
+		postrun_analysis.get_run_data = get_run_data
+	return results
+
+
+def git_commit():
+	try:
+		return subprocess.check_output(["git","rev-parse","--short","HEAD"],cwd=REPO_DIR,stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError,subprocess.CalledProcessError):
+		return None
+
+
+def compare(results,previous):
+	#prints the change of every timing against a previous results file
+	for (suite,cases) in results["benchmarks"].items():
+		for (case,stats) in cases.items():
+			try:
+				old_stats = previous["benchmarks"][suite][case]
+			except KeyError:
+				continue
+			for key in ["median_ms","seconds","rows_per_s"]:
+				if key in stats and key in old_stats and old_stats[key]:
+					print("{:<20} {:<22} {:<12} {:>12.4g} -> {:>12.4g} ({:+.1f}%)".format(suite,case,key,old_stats[key],stats[key],100*(stats[key]/old_stats[key]-1)))
+
+
+@click.command()
+@click.option('--output_directory',default=os.path.join(REPO_DIR,"benchmarks","results"),help='Directory the results json is written to.')
+@click.option('--device_counts',default="4,16,64",help='Comma separated numbers of mock MFCs for the tick benchmark.')
+@click.option('--iterations',default=200,help='Ticks/rows/steps timed per benchmark.')
+@click.option('--analysis_sizes',default="100,1000,10000",help='Comma separated numbers of injections for the analysis benchmark.')
+@click.option('--compare_to',default=None,help='Previous results json to compare against.')
+def main(output_directory,device_counts,iterations,analysis_sizes,compare_to):
+	"""Runs the benchmark suite and stores the results as json."""
+	device_counts = [int(i) for i in device_counts.split(",")]
+	analysis_sizes = [int(i) for i in analysis_sizes.split(",")]
+	workdir = tempfile.mkdtemp(prefix="auto_rxn_bench_")
+	try:
+		results = {"time" : time.ctime(),
+					"commit" : git_commit(),
+					"python" : platform.python_version(),
+					"platform" : platform.platform(),
+					"benchmarks" : {}}
+		print("Tick latency...")
+		results["benchmarks"]["tick"] = bench_tick(device_counts,iterations,workdir)
+		print("Log throughput...")
+		results["benchmarks"]["log"] = bench_log(device_counts[0],iterations,workdir)
+		print("Step switch latency...")
+		results["benchmarks"]["set_setpts"] = bench_set_setpts(device_counts[-1],iterations,workdir)
+		print("Post-run analysis...")
+		results["benchmarks"]["analyze"] = bench_analysis(analysis_sizes,workdir)
+	finally:
+		shutil.rmtree(workdir,ignore_errors=True)
+
+	print(json.dumps(results["benchmarks"],indent=1))
+	os.makedirs(output_directory,exist_ok=True)
+	output_file = os.path.join(output_directory,"bench_{}.json".format(time.strftime("%Y%m%d_%H%M%S")))
+	with open(output_file,'w') as f:
+		json.dump(results,f,indent=1)
+	print("Results written to {}".format(output_file))
+
+	if compare_to is not None:
+		with open(compare_to,'r') as f:
+			compare(results,json.load(f))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,7 @@
+"""Shared pytest setup for auto_rxn."""
+import os
+import sys
+
+# The driver modules import each other flat (they are run from inside auto_rxn/ and loaded by device name), so make them importable.
+# Appended rather than prepended so `import auto_rxn` still resolves to the package.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "auto_rxn"))
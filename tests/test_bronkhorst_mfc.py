@@ -0,0 +1,89 @@
+"""Tests for the chained FLOW-BUS reads in `bronkhorst_mfc`."""
+
+import pytest
+
+import bronkhorst_mfc
+import serial_bus
+
+
+def chained_reply(node, measure, setpoint):
+    """Answer a controller sends to `chained_read_command`: measure (param 0, chained) then setpoint (param 1)."""
+    return ":09{:02X}0201A0{:04X}21{:04X}\r\n".format(node, measure, setpoint)
+
+
+class FakeBus():
+    """Stands in for serial_bus.SerialBus. Answers chained reads from `replies` and single reads from `single_replies`."""
+
+    def __init__(self, replies, single_replies=None):
+        self.replies = replies  # chained command -> reply
+        self.single_replies = single_replies or {}
+        self.single_requests = []
+
+    def request_many(self, commands, terminator=b'\n'):
+        return [self.replies.get(command, "") for command in commands]
+
+    def request(self, command, terminator=b'\n'):
+        self.single_requests.append(command)
+        return self.single_replies.get(command, ":0403000005\r\n")
+
+
+@pytest.fixture
+def make_device(monkeypatch):
+    def make(bus):
+        monkeypatch.setattr(serial_bus, "get_bus", lambda port, baudrate, timeout=None: bus)
+        subdevices = {"N2": {"node": 3, "Max Setting": 100, "Flow Dev Lim": 2},
+                      "O2": {"node": 5, "Max Setting": 20, "Flow Dev Lim": 2}}
+        config = {"Flow Wait Time (sec)": 30, "port": "COM1", "baudrate": 38400, "timeout": 0.5, "Subdevices": subdevices}
+        params = {name: {"Units": "mL/min", "Emergency Setpoint": 0} for name in subdevices}
+        return bronkhorst_mfc.Device(params, config)
+    return make
+
+
+def test_chained_read_command():
+    subdev = bronkhorst_mfc.Subdevice("N2", {"Units": "mL/min", "Emergency Setpoint": 0}, {"node": 3, "Max Setting": 100, "Flow Dev Lim": 2})
+    command = subdev.chained_read_command()
+    assert command == ":09030401A00120210121\r\n"
+    data = bytes.fromhex(command[1:].strip())
+    assert data[0] == len(data) - 1  # length byte counts everything after itself
+    assert data[2] == 0x04  # request parameter
+    assert data[4] & 0x80  # measure is chained to the setpoint request
+
+
+def test_parse_chained_reply():
+    assert bronkhorst_mfc.parse_chained_reply(chained_reply(3, 16000, 32000)) == (3, {bronkhorst_mfc.MEASURE_PARAM: 16000, bronkhorst_mfc.SETPOINT_PARAM: 32000})
+    assert bronkhorst_mfc.parse_chained_reply(":090c0201a0000021ffff") == (12, {0: 0, 1: 0xFFFF})  # lower case hex, no terminator
+
+
+@pytest.mark.parametrize("reply", [
+    "",  # timed out
+    "0903020" + "1A03E80217D00",  # no leading colon
+    ":0403000005\r\n",  # status reply instead of an answer
+    ":0A0302" + "01A03E80217D00\r\n",  # length byte doesn't match
+    ":0903040" + "1A03E80217D00\r\n",  # not an answer (command 04)
+    ":070302" + "01A03E8021\r\n",  # chain cut short
+    ":090302" + "0180" + "3E80217D00\r\n",  # char parameter (type 0x00)
+    ":090302" + "01A03E80217D0G\r\n",  # not hex
+])
+def test_parse_chained_reply_rejects(reply):
+    assert bronkhorst_mfc.parse_chained_reply(reply) is None
+
+
+def test_read_all_pvs_uses_chained_replies(make_device):
+    bus = FakeBus({":09030401A00120210121\r\n": chained_reply(3, 16000, 8000),
+                   ":09050401A00120210121\r\n": chained_reply(5, 32000, 32000)})
+    device = make_device(bus)
+    bus.single_requests.clear()  # control mode writes from __init__
+    assert device.read_all_pvs() == {"N2": {"PV": 50.0, "SP": 25.0}, "O2": {"PV": 20.0, "SP": 20.0}}
+    assert bus.single_requests == []
+
+
+def test_read_all_pvs_falls_back_for_garbled_node(make_device):
+    bus = FakeBus({":09030401A00120210121\r\n": chained_reply(3, 16000, 8000),
+                   ":09050401A00120210121\r\n": ":09050201A07D"},  # cut off
+                  {":06050401210120\r\n": ":0605020121" + "3E80\r\n"})
+    device = make_device(bus)
+    bus.single_requests.clear()
+    readings = device.read_all_pvs()
+    assert readings["N2"] == {"PV": 50.0, "SP": 25.0}
+    assert readings["O2"]["PV"] == 10.0
+    assert bus.single_requests == [":06050401210120\r\n"]
@@ -0,0 +1,63 @@
+"""Tests for `modbus_registers` block planning and the register cache."""
+
+import struct
+
+import modbus_registers
+from modbus_registers import plan_blocks, RegisterCache
+
+
+def test_plan_blocks_merges_neighbours():
+    assert plan_blocks([1, 2]) == [(1, 3)]  # overlapping floats
+    assert plan_blocks([1, 3, 5]) == [(1, 6)]  # back to back
+    assert plan_blocks([5, 1, 3, 3]) == [(1, 6)]  # unsorted, duplicates
+
+
+def test_plan_blocks_gap():
+    assert plan_blocks([0, 10], max_gap=8) == [(0, 12)]  # 8 unused registers in between
+    assert plan_blocks([0, 11], max_gap=8) == [(0, 2), (11, 2)]
+    assert plan_blocks([0, 4], max_gap=0) == [(0, 2), (4, 2)]
+
+
+def test_plan_blocks_max_registers():
+    assert plan_blocks([0, 2, 4], max_registers=4) == [(0, 4), (4, 2)]
+    addresses = list(range(0, 400, 2))
+    blocks = plan_blocks(addresses)
+    assert all(count <= modbus_registers.MAX_BLOCK_REGISTERS for (start, count) in blocks)
+    covered = set()
+    for (start, count) in blocks:
+        covered.update(range(start, start + count))
+    assert all(address in covered and address + 1 in covered for address in addresses)  # every float is read whole
+
+
+def test_plan_blocks_empty():
+    assert plan_blocks([]) == []
+
+
+class FakeInstrument():
+    """minimalmodbus.Instrument stand-in holding float values at register addresses."""
+
+    def __init__(self, floats):
+        self.registers = {}
+        for (address, value) in floats.items():
+            (high, low) = struct.unpack('>HH', struct.pack('>f', value))
+            self.registers[address] = high
+            self.registers[address + 1] = low
+        self.block_reads = []
+
+    def read_registers(self, start, count):
+        self.block_reads.append((start, count))
+        return [self.registers.get(address, 0) for address in range(start, start + count)]
+
+    def read_float(self, address):
+        return struct.unpack('>f', struct.pack('>HH', self.registers[address], self.registers[address + 1]))[0]
+
+
+def test_register_cache_decodes_blocks():
+    dev = FakeInstrument({1: 451.5, 5: -10.25, 200: 3.0})
+    cache = RegisterCache(dev, [1, 5, 200])
+    cache.refresh()
+    assert dev.block_reads == [(1, 6), (200, 2)]
+    assert cache.get(1) == 451.5
+    assert cache.get(5) == -10.25
+    assert cache.get(200) == 3.0
+    assert cache.get(7) is None
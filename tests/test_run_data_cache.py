@@ -0,0 +1,46 @@
+"""Tests for `run_data_cache.RunDataCache`."""
+
+import os
+
+from run_data_cache import RunDataCache
+
+
+def disk_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def test_round_trip(tmp_path):
+    cache = RunDataCache(str(tmp_path))
+    assert cache.get("run-1") is None
+    cache.put("run-1", {"detectors": {"moduleA:tcd": [1, 2, 3]}})
+    assert cache.get("run-1") == {"detectors": {"moduleA:tcd": [1, 2, 3]}}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_misses_counted_once_per_run(tmp_path):
+    cache = RunDataCache(str(tmp_path))
+    for _ in range(3):  # ex. retries while the GC is still running
+        cache.get("run-1")
+    cache.get("run-2")
+    assert cache.misses == 2
+
+
+def test_rewrite_keeps_size(tmp_path):
+    cache = RunDataCache(str(tmp_path))
+    for _ in range(3):
+        cache.put("run-1", {"values": list(range(1000))})
+    assert cache.size == disk_size(str(tmp_path))
+    assert RunDataCache(str(tmp_path)).size == cache.size
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = RunDataCache(str(tmp_path))
+    cache.put("old", {"values": list(range(1000))})
+    entry_size = cache.size
+    cache = RunDataCache(str(tmp_path), max_bytes=2.5 * entry_size)
+    cache.put("new", {"values": list(range(1000))})
+    os.utime(cache.path("old"), (0, 0))  # least recently used
+    cache.put("newest", {"values": list(range(1000))})
+    assert cache.get("old") is None
+    assert cache.get("new") is not None
+    assert cache.size == disk_size(str(tmp_path))
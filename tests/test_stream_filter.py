@@ -0,0 +1,44 @@
+"""Tests for `stream_filter.StreamFilter`."""
+
+import pytest
+
+from stream_filter import StreamFilter
+
+
+def test_median_window():
+    f = StreamFilter("T", window=3)
+    assert [f.update(v) for v in [10, 30, 20, 40, 50]] == [10, 20, 20, 30, 40]
+
+
+def test_mean_window():
+    f = StreamFilter("T", window=2, mode="mean")
+    assert [f.update(v) for v in [10, 20, 40]] == [10, 15, 30]
+
+
+def test_rejects_spike_then_passes_repeated_values():
+    f = StreamFilter("T", max_value=1000, max_rejections=1)
+    assert [f.update(v) for v in [500, 5532, 501, 5532, 5532]] == [500, 500, 501, 501, 5532]
+
+
+def test_jump_becomes_new_baseline():
+    f = StreamFilter("T", window=3, max_jump=50, max_rejections=2)
+    assert [f.update(v) for v in [100, 101, 300, 300, 300, 301]] == [100, 100.5, 100.5, 100.5, 300, 300.5]
+
+
+def test_sentinel_passes_through_immediately():
+    f = StreamFilter("T", min_value=0, max_value=1000, max_rejections=2, pass_through=[-9999])
+    assert [f.update(v) for v in [25, -9999, -9999.0, 26]] == [25, -9999, -9999.0, 26]
+
+
+def test_not_a_number():
+    f = StreamFilter("T", max_rejections=2)
+    assert f.update(None) is None  # nothing to fall back on yet
+    assert [f.update(v) for v in [20, None, float("nan")]] == [20, 20, 20]
+
+
+def test_from_config():
+    f = StreamFilter.from_config("R1", {"Reactor Channel Filter": {"Window": 5, "Max": "None", "Pass Through": [-9999]}},
+                                 section="Reactor Channel Filter", max_value=1000, min_value=0)
+    assert (f.window, f.max_value, f.min_value, f.pass_through) == (5, None, 0, [-9999.0])
+    with pytest.raises(ValueError):
+        StreamFilter.from_config("R1", {"Filter": {"Widow": 5}})